@@ -1,8 +1,9 @@
-from flask import Flask, render_template, request, jsonify, send_file, url_for, after_this_request
+from flask import Flask, Request, Response, current_app, render_template, request, jsonify, send_file, url_for, after_this_request
 from werkzeug.utils import secure_filename
 from flask_cors import CORS
 import os
 import pandas as pd
+import openpyxl
 from PIL import Image, ImageDraw, ImageFont
 import json
 import io
@@ -17,14 +18,114 @@ import random
 import string
 import threading
 import time
+import hashlib
+import base64
+import sqlite3
+import itertools
+import csv
+import multiprocessing
+from collections import deque, OrderedDict
+from functools import lru_cache
+from contextlib import closing, nullcontext
+from enum import Enum
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from urllib.parse import urlsplit
+from requests.adapters import HTTPAdapter
+
+try:
+    import pyarrow as pa
+    import pyarrow.csv as pa_csv
+except ImportError:  # Optional: only needed for CSV_ENGINE=pyarrow
+    pa = pa_csv = None
+
+# Endpoints whose file uploads may be up to MAX_UPLOAD_SIZE instead of MAX_CONTENT_LENGTH
+UPLOAD_ENDPOINTS = {'upload_csv'}
+
+class AppRequest(Request):
+    """Request class with per-endpoint body limits.
+
+    Uploaded files are spooled to disk, but JSON and form bodies are read
+    into memory, so only UPLOAD_ENDPOINTS accept MAX_UPLOAD_SIZE. Also
+    applies MAX_FORM_MEMORY_SIZE, which Flask only reads itself from 3.1 on.
+    """
+    
+    @property
+    def max_content_length(self):
+        if self.endpoint in UPLOAD_ENDPOINTS:
+            return current_app.config['MAX_UPLOAD_SIZE']
+        return current_app.config['MAX_CONTENT_LENGTH']
+    
+    @property
+    def max_form_memory_size(self):
+        return current_app.config['MAX_FORM_MEMORY_SIZE']
 
 app = Flask(__name__)
+app.request_class = AppRequest
 CORS(app)  # Enable CORS for all routes
 
 # Configure upload folder and other settings
 app.config['UPLOAD_FOLDER'] = os.path.join('static', 'uploads')
-app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024  # 16MB max file size
+# Largest CSV/Excel upload; uploaded files are spooled to disk, not held in memory
+app.config['MAX_UPLOAD_SIZE'] = int(os.environ.get('MAX_UPLOAD_SIZE', 512 * 1024 * 1024))
+# Largest request body on every other endpoint (JSON bodies are read into memory)
+app.config['MAX_CONTENT_LENGTH'] = int(os.environ.get('MAX_CONTENT_LENGTH', 16 * 1024 * 1024))
+# Largest non-file form field, such as the payload of a streamed download
+app.config['MAX_FORM_MEMORY_SIZE'] = int(os.environ.get('MAX_FORM_MEMORY_SIZE', 16 * 1024 * 1024))
 app.config['SECRET_KEY'] = os.urandom(24)  # Generate a random secret key
+# Render engine settings: number of worker processes and rows per chunk
+app.config['RENDER_WORKERS'] = int(os.environ.get('RENDER_WORKERS', os.cpu_count() or 1))
+app.config['RENDER_CHUNK_SIZE'] = int(os.environ.get('RENDER_CHUNK_SIZE', 25))
+# Reuse one buffer per worker and only restore the areas each row drew on
+app.config['RENDER_COMPOSITE'] = os.environ.get('RENDER_COMPOSITE', 'true').lower() == 'true'
+# Overlay image downloads: concurrent requests overall and per host
+app.config['IMAGE_FETCH_WORKERS'] = int(os.environ.get('IMAGE_FETCH_WORKERS', 16))
+app.config['IMAGE_FETCH_PER_HOST'] = int(os.environ.get('IMAGE_FETCH_PER_HOST', 4))
+app.config['IMAGE_FETCH_TIMEOUT'] = float(os.environ.get('IMAGE_FETCH_TIMEOUT', 5))
+# On-disk cache for downloaded overlay images
+app.config['IMAGE_CACHE_DIR'] = os.environ.get('IMAGE_CACHE_DIR', os.path.join(app.instance_path, 'image_cache'))
+app.config['IMAGE_CACHE_MAX_BYTES'] = int(os.environ.get('IMAGE_CACHE_MAX_BYTES', 512 * 1024 * 1024))
+app.config['IMAGE_CACHE_TTL'] = int(os.environ.get('IMAGE_CACHE_TTL', 24 * 60 * 60))  # Seconds before revalidating
+app.config['IMAGE_CACHE_VARIANTS'] = os.environ.get('IMAGE_CACHE_VARIANTS', 'false').lower() == 'true'
+# Background merge jobs: SQLite job store and number of jobs run at once per process
+app.config['JOBS_DB'] = os.environ.get('JOBS_DB', os.path.join(app.instance_path, 'jobs.sqlite3'))
+app.config['JOB_WORKERS'] = int(os.environ.get('JOB_WORKERS', 2))
+# Running jobs without progress for JOB_STALE_AFTER seconds are marked failed (their
+# worker process is gone); finished jobs and their batch files are deleted after JOB_TTL seconds
+app.config['JOB_STALE_AFTER'] = float(os.environ.get('JOB_STALE_AFTER', 10 * 60))
+app.config['JOB_TTL'] = int(os.environ.get('JOB_TTL', 24 * 60 * 60))
+# Job event streams: how often the job store is checked and how long to wait for a job to appear
+app.config['JOB_EVENTS_INTERVAL'] = float(os.environ.get('JOB_EVENTS_INTERVAL', 0.2))
+app.config['JOB_EVENTS_WAIT'] = float(os.environ.get('JOB_EVENTS_WAIT', 10))
+# Job event streams end with 'failed' when a running job has made no progress for this many seconds
+app.config['JOB_EVENTS_STALL'] = float(os.environ.get('JOB_EVENTS_STALL', 5 * 60))
+# Zip entry compression: 'auto' stores already-compressed images and deflates the rest,
+# 'stored' or 'deflated' force one method for every entry
+app.config['ARCHIVE_COMPRESSION'] = os.environ.get('ARCHIVE_COMPRESSION', 'auto').lower()
+# Default output format ('png', 'jpeg', 'webp' or 'pdf'), JPEG/WebP quality and PDF page resolution
+app.config['OUTPUT_FORMAT'] = os.environ.get('OUTPUT_FORMAT', 'png').lower()
+app.config['OUTPUT_QUALITY'] = int(os.environ.get('OUTPUT_QUALITY', 90))
+app.config['PDF_DPI'] = float(os.environ.get('PDF_DPI', 72))
+# PNG encoder presets ('fast', 'default', 'small') for batch output and interactive previews
+app.config['PNG_PRESET'] = os.environ.get('PNG_PRESET', 'default').lower()
+app.config['PREVIEW_PNG_PRESET'] = os.environ.get('PREVIEW_PNG_PRESET', 'fast').lower()
+# Low-resolution previews (sent with a display size) are encoded as JPEG at this quality
+app.config['PREVIEW_QUALITY'] = int(os.environ.get('PREVIEW_QUALITY', 80))
+# Preview sessions: SQLite store for uploaded rows and layouts, and how long they are kept
+app.config['SESSIONS_DB'] = os.environ.get('SESSIONS_DB', os.path.join(app.instance_path, 'sessions.sqlite3'))
+app.config['SESSION_TTL'] = int(os.environ.get('SESSION_TTL', 24 * 60 * 60))
+# Uploaded CSV/Excel data is kept server-side as chunked datasets
+app.config['DATASETS_DIR'] = os.environ.get('DATASETS_DIR', os.path.join(app.instance_path, 'datasets'))
+app.config['DATASET_CHUNK_ROWS'] = int(os.environ.get('DATASET_CHUNK_ROWS', 10000))
+app.config['DATASET_TTL'] = int(os.environ.get('DATASET_TTL', 24 * 60 * 60))
+app.config['DATASET_PAGE_MAX'] = int(os.environ.get('DATASET_PAGE_MAX', 1000))  # Rows per /datasets/<id>/rows request
+# CSV parser for uploads: 'c' (pandas' default), 'pyarrow' (needs the pyarrow package),
+# 'python' (the csv module, row by row) or 'auto' (pyarrow when installed, else 'c')
+app.config['CSV_ENGINE'] = os.environ.get('CSV_ENGINE', 'auto').lower()
+# Readers of a dataset that is still being parsed give up if no chunk arrives for this many seconds
+app.config['DATASET_WAIT_TIMEOUT'] = float(os.environ.get('DATASET_WAIT_TIMEOUT', 60))
+# Interactive previews are capped; full merges go through /render_batch
+app.config['PREVIEW_MAX_ROWS'] = int(os.environ.get('PREVIEW_MAX_ROWS', 10))
 
 # Ensure required directories exist
 os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
@@ -34,11 +135,19 @@ os.makedirs(os.path.join('static', 'fonts'), exist_ok=True)
 
 # Font management
 FONTS_DIR = os.path.join('static', 'fonts')
-DEFAULT_FONT = os.path.join(FONTS_DIR, 'arial.ttf')
 
-# Global variables to track progress
-preview_progress = {"percent": 0, "status": "idle"}
-download_progress = {"percent": 0, "status": "idle"}
+# Maximum number of parsed font faces kept per process
+FONT_CACHE_SIZE = int(os.environ.get('FONT_CACHE_SIZE', 64))
+# Maximum number of wrapped text values remembered per process
+WRAP_CACHE_SIZE = int(os.environ.get('WRAP_CACHE_SIZE', 4096))
+# Maximum number of resized overlay images kept per process
+OVERLAY_CACHE_SIZE = int(os.environ.get('OVERLAY_CACHE_SIZE', 64))
+# Maximum number of decoded dataset chunks kept per process
+DATASET_CACHE_SIZE = int(os.environ.get('DATASET_CACHE_SIZE', 8))
+# Maximum number of downscaled preview templates kept per process
+TEMPLATE_CACHE_SIZE = int(os.environ.get('TEMPLATE_CACHE_SIZE', 16))
+# Maximum number of compiled render states (template + layout) kept per render worker
+RENDER_STATE_CACHE_SIZE = int(os.environ.get('RENDER_STATE_CACHE_SIZE', 4))
 
 # Ensure fonts directory exists
 os.makedirs(FONTS_DIR, exist_ok=True)
@@ -123,6 +232,64 @@ def get_font_path(font_name, bold=False, italic=False):
     
     return font_path
 
+class LRUCache:
+    """Small thread-safe LRU mapping with a size cap and hit/miss counters."""
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value = self._data[key]
+            except KeyError:
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            # Evict the least recently used entries
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'size': len(self._data),
+                'max_size': self.max_size
+            }
+
+def get_font(font_name='Arial', font_size=12, bold=False, italic=False):
+    """Return a loaded font, parsing each (family, size, bold, italic) face only once."""
+    return _load_font(font_name.lower().replace(' ', ''), int(font_size), bool(bold), bool(italic))
+
+@lru_cache(maxsize=FONT_CACHE_SIZE)
+def _load_font(font_name, font_size, bold, italic):
+    """Parse a TrueType font file (cached by get_font)."""
+    font_path = get_font_path(font_name, bold=bold, italic=italic)
+    return ImageFont.truetype(font_path, font_size)
+
+def font_cache_stats():
+    """Return hit/miss counters for this process's font cache."""
+    info = _load_font.cache_info()
+    return {
+        'hits': info.hits,
+        'misses': info.misses,
+        'size': info.currsize,
+        'max_size': info.maxsize
+    }
+
 @app.route('/')
 def index():
     return render_template('index.html')
@@ -161,8 +328,473 @@ def upload_template():
         'message': 'Template uploaded successfully'
     })
 
+# Datasets
+#
+# Uploaded sheets are stored server-side and referenced by id, so merge
+# requests carry a dataset id and optional row range instead of every row.
+# A dataset is a directory holding meta.json and the rows as pickled
+# DataFrame chunks (pyarrow is not a dependency, and the files are only
+# ever read back by this app). meta.json is replaced atomically after each
+# chunk, so readers in other worker processes always see whole chunks.
+# Uploads are parsed chunk by chunk in a background thread; readers
+# iterating a dataset that is not complete yet wait for the next chunk, so
+# rendering can start as soon as the first one is stored.
+
+# Decoded dataset chunks, keyed by (dataset id, chunk number)
+_dataset_chunk_cache = LRUCache(DATASET_CACHE_SIZE)
+
+def frame_records(df):
+    """Convert a DataFrame to row dicts, with missing cells as None."""
+    return df.astype(object).where(df.notna(), None).to_dict('records')
+
+class Dataset:
+    """Rows of one upload, stored as numbered chunk files."""
+    
+    def __init__(self, dataset_id, meta):
+        self.id = dataset_id
+        self.meta = meta
+    
+    @staticmethod
+    def _dir(dataset_id):
+        return os.path.join(app.config['DATASETS_DIR'], dataset_id)
+    
+    @classmethod
+    def create(cls, source=None):
+        """Start an empty dataset, removing expired ones first."""
+        cls.purge_expired()
+        dataset_id = generate_unique_id(16)
+        os.makedirs(cls._dir(dataset_id))
+        dataset = cls(dataset_id, {
+            'id': dataset_id,
+            'source': source,
+            'columns': [],
+            'chunks': [],
+            'row_count': 0,
+            'complete': False,
+            'error': None,
+            'created_at': time.time()
+        })
+        dataset._save_meta()
+        return dataset
+    
+    @classmethod
+    def open(cls, dataset_id):
+        """Return a stored dataset, or None if the id is unknown or expired."""
+        if not dataset_id or not str(dataset_id).isalnum():
+            return None
+        try:
+            with open(os.path.join(cls._dir(dataset_id), 'meta.json'), 'r', encoding='utf-8') as f:
+                meta = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if meta['created_at'] < time.time() - app.config['DATASET_TTL']:
+            return None
+        return cls(dataset_id, meta)
+    
+    @classmethod
+    def purge_expired(cls):
+        """Delete datasets older than DATASET_TTL."""
+        cutoff = time.time() - app.config['DATASET_TTL']
+        for meta_path in glob.glob(os.path.join(app.config['DATASETS_DIR'], '*', 'meta.json')):
+            try:
+                if os.path.getmtime(meta_path) < cutoff:
+                    shutil.rmtree(os.path.dirname(meta_path))
+            except OSError as e:
+                print(f"Warning: Could not remove expired dataset {meta_path}: {e}")
+    
+    @property
+    def columns(self):
+        return self.meta['columns']
+    
+    @property
+    def row_count(self):
+        return self.meta['row_count']
+    
+    @property
+    def complete(self):
+        return self.meta['complete']
+    
+    def refresh(self):
+        """Reload meta.json to pick up chunks written since the dataset was opened."""
+        with open(os.path.join(self._dir(self.id), 'meta.json'), 'r', encoding='utf-8') as f:
+            self.meta = json.load(f)
+    
+    def wait(self, chunk_count, timeout=None, interval=0.1):
+        """Block until the dataset has more than ``chunk_count`` chunks or is complete.
+        
+        Raises TimeoutError if no chunk arrives within ``timeout`` seconds and
+        ValueError if parsing the upload failed.
+        """
+        timeout = app.config['DATASET_WAIT_TIMEOUT'] if timeout is None else timeout
+        deadline = time.time() + timeout
+        while len(self.meta['chunks']) <= chunk_count and not self.complete:
+            if time.time() >= deadline:
+                raise TimeoutError(f'Dataset {self.id} stopped receiving rows')
+            time.sleep(interval)
+            self.refresh()
+        if self.meta['error']:
+            raise ValueError(f"Dataset could not be read: {self.meta['error']}")
+    
+    def _save_meta(self):
+        path = os.path.join(self._dir(self.id), 'meta.json')
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            json.dump(self.meta, f)
+        os.replace(tmp_path, path)
+    
+    def _chunk_path(self, number):
+        return os.path.join(self._dir(self.id), f'chunk_{number:05d}.pkl')
+    
+    def append(self, df):
+        """Store a DataFrame of rows as the next chunk."""
+        if not self.meta['columns']:
+            self.meta['columns'] = [str(column) for column in df.columns]
+        df = df.set_axis(self.meta['columns'], axis=1).reset_index(drop=True)
+        number = len(self.meta['chunks'])
+        df.to_pickle(self._chunk_path(number))
+        self.meta['chunks'].append(len(df))
+        self.meta['row_count'] += len(df)
+        self._save_meta()
+    
+    def finish(self, error=None):
+        """Mark the dataset as fully written (or failed with ``error``)."""
+        self.meta['complete'] = True
+        self.meta['error'] = error
+        self._save_meta()
+    
+    def read_chunk(self, number):
+        """Return one chunk as a DataFrame, shared through a per-process cache."""
+        key = (self.id, number)
+        df = _dataset_chunk_cache.get(key)
+        if df is None:
+            df = pd.read_pickle(self._chunk_path(number))
+            _dataset_chunk_cache.put(key, df)
+        return df
+    
+    def iter_frames(self, start=0, stop=None, wait=True):
+        """Yield DataFrame slices covering rows [start, stop).
+        
+        While the dataset is still being written, waits for further chunks
+        unless ``wait`` is false, in which case only the stored rows are read.
+        """
+        number = 0
+        chunk_start = 0
+        while stop is None or chunk_start < stop:
+            if number == len(self.meta['chunks']):
+                if self.complete or not wait:
+                    break
+                self.wait(number)
+                continue
+            chunk_stop = chunk_start + self.meta['chunks'][number]
+            if chunk_stop > start:
+                df = self.read_chunk(number)
+                end = chunk_stop if stop is None else min(stop, chunk_stop)
+                yield df.iloc[max(start - chunk_start, 0):end - chunk_start]
+            chunk_start = chunk_stop
+            number += 1
+    
+    def iter_rows(self, start=0, stop=None, wait=True):
+        """Yield rows [start, stop) as dicts, one chunk in memory at a time."""
+        for frame in self.iter_frames(start, stop, wait):
+            yield from frame_records(frame)
+    
+    def read_rows(self, offset=0, limit=None, columns=None):
+        """Return up to ``limit`` rows from ``offset``, optionally only some columns."""
+        stop = None if limit is None else offset + limit
+        records = []
+        for frame in self.iter_frames(offset, stop, wait=False):
+            if columns is not None:
+                frame = frame[columns]
+            records.extend(frame_records(frame))
+        return records
+
+def row_range(data, total):
+    """Read an optional [row_start, row_end) range from a request, clamped to ``total`` rows.
+    
+    ``total`` is None while a dataset is still being parsed; an open-ended
+    range then has no end either.
+    """
+    try:
+        start = int(data.get('row_start') or 0)
+        stop = None if data.get('row_end') is None else int(data.get('row_end'))
+    except (TypeError, ValueError):
+        raise ValueError("row_start and row_end must be integers")
+    if total is not None:
+        stop = total if stop is None else min(stop, total)
+    if start < 0 or (stop is not None and stop < start):
+        raise ValueError("Invalid row range")
+    return start, stop
+
+def request_rows(data):
+    """Return (rows, row_count) for a merge request.
+
+    Rows come from the stored dataset named by ``dataset_id`` or, for older
+    clients, from the inline ``csv_data`` list, limited to the optional
+    ``row_start``/``row_end`` range. The row count is None for an open-ended
+    range over a dataset that is still being parsed. Raises LookupError for
+    unknown datasets and ValueError for bad ranges.
+    """
+    dataset_id = data.get('dataset_id')
+    if dataset_id is None:
+        csv_data = data.get('csv_data') or []
+        start, stop = row_range(data, len(csv_data))
+        return csv_data[start:stop], stop - start
+    
+    dataset = Dataset.open(dataset_id)
+    if dataset is None:
+        raise LookupError(f'Dataset not found: {dataset_id}')
+    if dataset.meta['error']:
+        raise ValueError(f"Dataset could not be read: {dataset.meta['error']}")
+    start, stop = row_range(data, dataset.row_count if dataset.complete else None)
+    return dataset.iter_rows(start, stop), (None if stop is None else stop - start)
+
+# CSV parsing
+#
+# Every engine yields DataFrames of at most DATASET_CHUNK_ROWS rows with all
+# columns read as text, so ZIP codes and IDs keep their leading zeros, and
+# only empty cells become missing values. Malformed lines with too many
+# fields are skipped, lines with too few are padded with missing values and
+# the header is named the way pandas names it, so the engines produce the
+# same dataset. Arrow can only skip or reject short lines, so the pyarrow
+# engine hands over to the C engine at the first one.
+
+CSV_ENGINES = ('c', 'pyarrow', 'python')
+
+def csv_engine(name=None):
+    """Resolve a CSV_ENGINE setting to the name of an available engine."""
+    name = (name or app.config['CSV_ENGINE']).lower()
+    if name == 'auto':
+        return 'c' if pa_csv is None else 'pyarrow'
+    if name not in CSV_ENGINES:
+        raise ValueError(f"Unknown CSV engine: {name}")
+    if name == 'pyarrow' and pa_csv is None:
+        print("Warning: pyarrow is not installed, parsing CSV with the C engine")
+        return 'c'
+    return name
+
+def csv_column_names(header):
+    """Name header cells like pandas: blanks become 'Unnamed: N', repeats get '.1', '.2', ..."""
+    if not header:
+        raise ValueError("No columns to parse from file")
+    names = []
+    for idx, name in enumerate(header):
+        name = base = name or f'Unnamed: {idx}'
+        count = 0
+        while name in names:
+            count += 1
+            name = f'{base}.{count}'
+        names.append(name)
+    return names
+
+def read_csv_header(path):
+    """Return the column names of a CSV file."""
+    with open(path, 'r', encoding='utf-8-sig', newline='') as f:
+        return csv_column_names(next(csv.reader(f), []))
+
+def rechunk_frames(frames, chunk_rows):
+    """Regroup DataFrames into frames of ``chunk_rows`` rows (the last may be shorter).
+
+    An input without rows still yields one empty frame, which carries the columns.
+    """
+    pending = []
+    pending_rows = 0
+    yielded = False
+    for df in frames:
+        pending.append(df)
+        pending_rows += len(df)
+        while pending_rows >= chunk_rows:
+            df = pd.concat(pending, ignore_index=True)
+            yield df.iloc[:chunk_rows]
+            yielded = True
+            pending = [df.iloc[chunk_rows:]]
+            pending_rows -= chunk_rows
+    if pending and (pending_rows or not yielded):
+        yield pd.concat(pending, ignore_index=True)
+
+def skip_frame_rows(frames, count):
+    """Drop the first ``count`` rows from a stream of DataFrames."""
+    for df in frames:
+        if count and count >= len(df):
+            count -= len(df)
+            continue
+        yield df.iloc[count:]
+        count = 0
+
+def _arrow_invalid_row(row):
+    return 'skip' if row.actual_columns > row.expected_columns else 'error'
+
+def _iter_csv_c(path, chunk_rows):
+    # encoding='utf-8-sig' handles the BOM that Excel puts in CSV exports
+    with pd.read_csv(path, encoding='utf-8-sig', on_bad_lines='skip', chunksize=chunk_rows,
+                     dtype=str, keep_default_na=False, na_values=['']) as reader:
+        yield from reader
+
+def _iter_csv_pyarrow(path, chunk_rows):
+    columns = read_csv_header(path)
+    rows_read = 0
+    try:
+        reader = pa_csv.open_csv(
+            path,
+            read_options=pa_csv.ReadOptions(column_names=columns, skip_rows=1),
+            parse_options=pa_csv.ParseOptions(newlines_in_values=True, invalid_row_handler=_arrow_invalid_row),
+            convert_options=pa_csv.ConvertOptions(
+                column_types={name: pa.string() for name in columns},
+                null_values=[''],
+                strings_can_be_null=True
+            )
+        )
+        for batch in reader:
+            df = batch.to_pandas()
+            rows_read += len(df)
+            yield df
+    except pa.ArrowInvalid as e:
+        # A short line (or a parse error): the C engine carries on from the
+        # first row not read yet, and reports real errors itself
+        print(f"Note: switching to the C engine after {rows_read} CSV rows: {e}")
+        yield from skip_frame_rows(_iter_csv_c(path, chunk_rows), rows_read)
+        return
+    if rows_read == 0:
+        yield pd.DataFrame(columns=columns, dtype=object)
+
+def row_frames(rows, columns, chunk_rows):
+    """Group row value lists into DataFrames of ``chunk_rows`` rows.
+
+    An input without rows still yields one empty frame, which carries the columns.
+    """
+    chunk = []
+    yielded = False
+    for row in rows:
+        chunk.append(row)
+        if len(chunk) == chunk_rows:
+            yield pd.DataFrame(chunk, columns=columns, dtype=object)
+            yielded = True
+            chunk = []
+    if chunk or not yielded:
+        yield pd.DataFrame(chunk, columns=columns, dtype=object)
+
+def _iter_csv_python(path, chunk_rows):
+    with open(path, 'r', encoding='utf-8-sig', newline='') as f:
+        reader = csv.reader(f)
+        columns = csv_column_names(next(reader, []))
+        width = len(columns)
+        rows = (
+            [value or None for value in row] + [None] * (width - len(row))
+            for row in reader if row and len(row) <= width
+        )
+        yield from row_frames(rows, columns, chunk_rows)
+
+def iter_csv_frames(path, chunk_rows=None, engine=None):
+    """Parse a CSV file into DataFrames of up to ``chunk_rows`` rows of text."""
+    chunk_rows = chunk_rows or app.config['DATASET_CHUNK_ROWS']
+    engine = csv_engine(engine)
+    if engine == 'pyarrow':
+        yield from rechunk_frames(_iter_csv_pyarrow(path, chunk_rows), chunk_rows)
+    elif engine == 'python':
+        yield from _iter_csv_python(path, chunk_rows)
+    else:
+        yield from _iter_csv_c(path, chunk_rows)
+
+# Excel parsing
+#
+# .xlsx sheets are read with openpyxl in read-only mode, which streams rows
+# from the worksheet XML instead of building the whole workbook in memory.
+# Cells are converted to the same text the CSV engines produce. xlrd has no
+# streaming mode, so .xls sheets (at most 65536 rows) still go through pandas.
+
+def excel_sheet_names(path):
+    """List the worksheet names of an .xlsx or .xls workbook."""
+    if path.lower().endswith('.xls'):
+        with pd.ExcelFile(path) as workbook:
+            return workbook.sheet_names
+    workbook = openpyxl.load_workbook(path, read_only=True)
+    try:
+        return [worksheet.title for worksheet in workbook.worksheets]
+    finally:
+        workbook.close()
+
+def select_sheet(sheets, sheet=None):
+    """Pick a sheet by name or 0-based position, defaulting to the first one."""
+    if not sheet:
+        return sheets[0]
+    if sheet in sheets:
+        return sheet
+    if str(sheet).isdigit() and int(sheet) < len(sheets):
+        return sheets[int(sheet)]
+    raise ValueError(f"Worksheet not found: {sheet}")
+
+def excel_cell_text(value):
+    """Convert an Excel cell value to text, or None for an empty cell.
+
+    Whole numbers lose their '.0', dates at midnight lose their time and
+    booleans are written the way Excel shows them.
+    """
+    if value is None or value == '':
+        return None
+    if isinstance(value, bool):
+        return 'TRUE' if value else 'FALSE'
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    if isinstance(value, datetime) and not (value.hour or value.minute or value.second or value.microsecond):
+        return value.date().isoformat()
+    return str(value)
+
+def _iter_xlsx_rows(path, sheet):
+    workbook = openpyxl.load_workbook(path, read_only=True, data_only=True)
+    try:
+        worksheet = workbook[sheet]
+        # The dimensions saved in a workbook are often wrong; read rows as stored
+        worksheet.reset_dimensions()
+        yield from worksheet.iter_rows(values_only=True)
+    finally:
+        workbook.close()
+
+def iter_excel_frames(path, sheet, chunk_rows=None):
+    """Parse one worksheet into DataFrames of up to ``chunk_rows`` rows of text."""
+    chunk_rows = chunk_rows or app.config['DATASET_CHUNK_ROWS']
+    if path.lower().endswith('.xls'):
+        df = pd.read_excel(path, sheet_name=sheet, dtype=str, keep_default_na=False, na_values=[''])
+        yield from rechunk_frames([df], chunk_rows)
+        return
+    
+    rows = _iter_xlsx_rows(path, sheet)
+    columns = csv_column_names([excel_cell_text(value) or '' for value in next(rows, ())])
+    width = len(columns)
+    # Cells right of the header are dropped and blank rows skipped, as pandas does
+    values = ([excel_cell_text(value) for value in row[:width]] for row in rows)
+    yield from row_frames(
+        (row + [None] * (width - len(row)) for row in values if any(value is not None for value in row)),
+        columns,
+        chunk_rows
+    )
+
+def ingest_upload(dataset, path, frames, progress):
+    """Store the parsed ``frames`` of an upload in ``dataset`` as they arrive, then delete the file."""
+    try:
+        for df in frames:
+            dataset.append(df)
+            progress.advance(len(df))
+        dataset.finish()
+        progress.complete(dataset_summary(dataset))
+    except Exception as e:
+        print(f"Error reading upload {dataset.meta['source']}: {str(e)}")
+        dataset.finish(error=str(e))
+        progress.fail(str(e))
+    finally:
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
 @app.route('/upload_csv', methods=['POST'])
 def upload_csv():
+    """Store an uploaded CSV or Excel sheet as a dataset
+
+    Files are parsed in the background: the response is sent once the first
+    chunk is stored, with ``complete`` false and an ``ingest_job_id`` whose
+    progress (GET /jobs/<id>/events) counts the rows parsed so far. For
+    workbooks the form field ``sheet`` picks a worksheet by name or position
+    (default: the first), and ``sheets`` lists the available ones.
+    """
     if 'csv' not in request.files:
         return jsonify({'error': 'No file uploaded'}), 400
     
@@ -170,64 +802,159 @@ def upload_csv():
     if file.filename == '':
         return jsonify({'error': 'No file selected'}), 400
     
+    # Check file extension to determine if it's CSV or Excel
+    extension = os.path.splitext(file.filename.lower())[1]
+    if extension not in ('.csv', '.xlsx', '.xls'):
+        return jsonify({'error': 'Unsupported file format. Please upload a CSV or Excel file'}), 400
+    
     try:
-        # Check file extension to determine if it's CSV or Excel
-        if file.filename.lower().endswith('.csv'):
-            # For CSV files, use encoding='utf-8-sig' to handle BOM and other encoding issues
-            df = pd.read_csv(file, encoding='utf-8-sig', on_bad_lines='skip')
-        elif file.filename.lower().endswith(('.xlsx', '.xls')):
-            # For Excel files
-            df = pd.read_excel(file)
-        else:
-            return jsonify({'error': 'Unsupported file format. Please upload a CSV or Excel file'}), 400
+        # Keep the rows server-side; merge requests refer to them by dataset id
+        dataset = Dataset.create(source=file.filename)
+        try:
+            # Copy the upload next to the dataset and parse it in the background,
+            # so only one chunk of rows is ever held in memory
+            path = os.path.join(Dataset._dir(dataset.id), 'upload' + extension)
+            file.save(path)
+            sheets = sheet = None
+            if extension == '.csv':
+                frames = iter_csv_frames(path)
+            else:
+                sheets = excel_sheet_names(path)
+                sheet = select_sheet(sheets, request.form.get('sheet'))
+                frames = iter_excel_frames(path, sheet)
+            ingest_job_id = create_job('ingest', {'dataset_id': dataset.id}, state=JOB_RUNNING)
+        except Exception:
+            # Nothing will ever read this dataset; don't keep the upload until it expires
+            shutil.rmtree(Dataset._dir(dataset.id), ignore_errors=True)
+            raise
+        threading.Thread(target=ingest_upload, daemon=True,
+                         args=(dataset, path, frames, JobProgress(ingest_job_id))).start()
+        # Respond once the first chunk (and so the columns) is known
+        dataset = Dataset.open(dataset.id)
+        dataset.wait(0)
         
-        preview_rows = min(20, len(df))  # Show up to 20 rows in preview
         return jsonify({
-            'columns': df.columns.tolist(),
-            'preview': df.head(preview_rows).to_dict('records'),
-            'all_data': df.to_dict('records'),  # Send all rows
-            'total_rows': len(df)
+            'dataset_id': dataset.id,
+            'ingest_job_id': ingest_job_id,
+            'sheets': sheets,
+            'sheet': sheet,
+            'columns': dataset.columns,
+            'preview': dataset.read_rows(0, 20),  # Show up to 20 rows in preview
+            'total_rows': dataset.row_count,
+            'complete': dataset.complete
         })
     except Exception as e:
         return jsonify({'error': f"Error reading file: {str(e)}"}), 400
 
+def dataset_summary(dataset):
+    """Public metadata of a dataset."""
+    return {
+        'id': dataset.id,
+        'source': dataset.meta['source'],
+        'columns': dataset.columns,
+        'total_rows': dataset.row_count,
+        'complete': dataset.complete,
+        'error': dataset.meta['error'],
+        'created_at': dataset.meta['created_at']
+    }
+
+@app.route('/datasets/<string:dataset_id>')
+def dataset_status(dataset_id):
+    """Report the columns and row count of an uploaded dataset"""
+    dataset = Dataset.open(dataset_id)
+    if dataset is None:
+        return jsonify({'error': 'Dataset not found'}), 404
+    return jsonify(dataset_summary(dataset))
+
+@app.route('/datasets/<string:dataset_id>/rows')
+def dataset_rows(dataset_id):
+    """Return a window of a dataset's rows
+
+    Query parameters: ``offset`` (default 0), ``limit`` (default 20, capped
+    at DATASET_PAGE_MAX) and ``columns``, a comma-separated projection.
+    """
+    dataset = Dataset.open(dataset_id)
+    if dataset is None:
+        return jsonify({'error': 'Dataset not found'}), 404
+    
+    try:
+        offset = int(request.args.get('offset', 0))
+        limit = int(request.args.get('limit', 20))
+    except ValueError:
+        return jsonify({'error': 'offset and limit must be integers'}), 400
+    if offset < 0 or limit < 0:
+        return jsonify({'error': 'offset and limit must not be negative'}), 400
+    limit = min(limit, app.config['DATASET_PAGE_MAX'])
+    
+    columns = dataset.columns
+    if request.args.get('columns'):
+        columns = [column for column in request.args['columns'].split(',') if column]
+        unknown = [column for column in columns if column not in dataset.columns]
+        if unknown:
+            return jsonify({'error': f"Unknown columns: {', '.join(unknown)}"}), 400
+    
+    return jsonify({
+        'offset': offset,
+        'limit': limit,
+        'columns': columns,
+        'total_rows': dataset.row_count,
+        'rows': dataset.read_rows(offset, limit, columns)
+    })
+
 def wrap_text_to_width(draw, text, font, max_width):
-    """Helper function to wrap text based on given width"""
+    """Helper function to wrap text based on given width
+
+    Each word and the space are measured once and line widths are summed
+    incrementally. The joined line is only re-measured (to pick up kerning)
+    when the running total lands near the break point, and over-long words
+    are split with a binary search instead of a char-by-char scan.
+    """
     words = text.split()
     lines = []
     current_line = []
+    current_width = 0
     
     if not words:
         return []
     
+    space_width = draw.textlength(' ', font=font)
+    word_widths = {}
+    
     for word in words:
+        word_width = word_widths.get(word)
+        if word_width is None:
+            word_width = word_widths[word] = draw.textlength(word, font=font)
+        
         # Try adding the word to the current line
-        test_line = current_line + [word]
-        test_width = draw.textlength(' '.join(test_line), font=font)
+        if current_line:
+            test_width = current_width + space_width + word_width
+            # Kerning can shift the real width slightly, so confirm with an
+            # exact measurement whenever we are close to the limit
+            if test_width > max_width - space_width:
+                test_width = draw.textlength(' '.join(current_line) + ' ' + word, font=font)
+        else:
+            test_width = word_width
         
         if test_width <= max_width:
             current_line.append(word)
-        else:
+            current_width = test_width
+        elif current_line:
             # If current line has words, add it to lines
-            if current_line:
-                lines.append(' '.join(current_line))
-                current_line = [word]
+            lines.append(' '.join(current_line))
+            current_line = [word]
+            current_width = word_width
+        else:
+            # If a single word is too long, split it
+            pieces = split_word_to_width(draw, word, font, max_width)
+            lines.extend(pieces[:-1])
+            # The remainder can take following words unless it is a single
+            # character that is wider than the box on its own
+            last_width = draw.textlength(pieces[-1], font=font)
+            if last_width <= max_width:
+                current_line = [pieces[-1]]
+                current_width = last_width
             else:
-                # If a single word is too long, split it
-                chars = list(word)
-                current_chars = []
-                for char in chars:
-                    test_chars = current_chars + [char]
-                    if draw.textlength(''.join(test_chars), font=font) <= max_width:
-                        current_chars.append(char)
-                    else:
-                        if current_chars:
-                            lines.append(''.join(current_chars))
-                            current_chars = [char]
-                        else:
-                            lines.append(char)
-                if current_chars:
-                    current_line = [''.join(current_chars)]
+                lines.append(pieces[-1])
     
     # Add the last line if there's anything left
     if current_line:
@@ -235,53 +962,183 @@ def wrap_text_to_width(draw, text, font, max_width):
     
     return lines
 
-def draw_text_box(draw, box, text, img_width, img_height):
-    """Helper function to draw text box with proper wrapping and alignment"""
+# Wrapped lines and their widths, keyed by (text, font key, box width)
+_wrap_cache = LRUCache(WRAP_CACHE_SIZE)
+
+def measure_wrapped_text(draw, text, font, font_key, max_width):
+    """Return (lines, line_widths) for text wrapped to max_width.
+
+    Merge columns often repeat the same value on thousands of rows, so the
+    result is memoized and repeated values cost a single dict lookup.
+    """
+    key = (text, font_key, max_width)
+    result = _wrap_cache.get(key)
+    if result is None:
+        lines = tuple(wrap_text_to_width(draw, text, font, max_width))
+        widths = tuple(draw.textlength(line, font=font) for line in lines)
+        result = (lines, widths)
+        _wrap_cache.put(key, result)
+    return result
+
+def wrap_cache_stats():
+    """Return hit/miss counters for this process's wrap cache."""
+    return _wrap_cache.stats()
+
+def split_word_to_width(draw, word, font, max_width):
+    """Split a word into the longest prefixes that fit max_width (binary search)."""
+    pieces = []
+    start = 0
+    while start < len(word):
+        # Find the longest prefix of word[start:] that fits
+        lo, hi = 0, len(word) - start
+        while lo < hi:
+            mid = (lo + hi + 1) // 2
+            if draw.textlength(word[start:start + mid], font=font) <= max_width:
+                lo = mid
+            else:
+                hi = mid - 1
+        # A single character wider than the box still gets its own line
+        length = max(lo, 1)
+        pieces.append(word[start:start + length])
+        start += length
+    return pieces
+
+# Layout plans
+#
+# Box configs arrive from the browser as loosely typed dicts (numbers as
+# strings, booleans as 'true'/'false', hex colours). compile_layout() parses
+# them once per job into immutable plan objects so the per-row loop only
+# deals with ints, tuples and loaded fonts.
+
+class Align(Enum):
+    """Horizontal text alignment within a box."""
+    LEFT = 'left'
+    CENTER = 'center'
+    RIGHT = 'right'
+
+def str_to_bool(val):
+    """Convert string 'true'/'false' (or a real bool) to a boolean."""
+    if isinstance(val, bool):
+        return val
+    return str(val).lower() == 'true'
+
+def parse_hex_color(color_str, default=(0, 0, 0)):
+    """Convert a '#rrggbb' string to an RGB tuple."""
+    if not isinstance(color_str, str) or not color_str.startswith('#'):
+        return default
     try:
+        return tuple(int(color_str[i:i+2], 16) for i in (1, 3, 5))
+    except ValueError:
+        return default
+
+class _FrozenPlan:
+    """Base for slot-based plan objects that cannot be modified once built."""
+    __slots__ = ()
+
+    def __setattr__(self, name, value):
+        raise AttributeError(f"{type(self).__name__} is immutable")
+
+    def __delattr__(self, name):
+        raise AttributeError(f"{type(self).__name__} is immutable")
+
+class TextBoxPlan(_FrozenPlan):
+    """Pre-parsed settings for a text box.
+
+    ``scale`` maps template coordinates onto a resized render target; the
+    font size is clamped to its allowed range before it is scaled.
+    """
+    __slots__ = ('column', 'x', 'y', 'width', 'height', 'font', 'font_key',
+                 'font_size', 'line_height', 'color', 'align', 'underline',
+                 'strikethrough')
+
+    def __init__(self, box, scale=1.0):
         # Get font size and validate
-        font_size = int(box.get('fontSize', 24))
-        if font_size < 8:
-            font_size = 8
-        elif font_size > 200:
-            font_size = 200
-            
+        font_size = int(float(box.get('fontSize', 24)))
+        font_size = min(max(font_size, 8), 200)
+        if scale != 1.0:
+            font_size = max(1, round(font_size * scale))
+        
         # Get font family and style
         font_family = box.get('fontFamily', 'Arial')
-        
-        # Convert string 'true'/'false' to boolean
-        def str_to_bool(val):
-            if isinstance(val, bool):
-                return val
-            return str(val).lower() == 'true'
-        
-        # Check for bold/italic styles
         is_bold = str_to_bool(box.get('bold', False))
         is_italic = str_to_bool(box.get('italic', False))
-        is_underline = str_to_bool(box.get('underline', False))
-        is_strikethrough = str_to_bool(box.get('strikethrough', False))
-        
-        # Get text alignment
-        text_align = box.get('align', 'left')
-        
-        # Create appropriate font based on style
-        font_path = get_font_path(font_family, bold=is_bold, italic=is_italic)
-        font = ImageFont.truetype(font_path, font_size)
-        
-        # Get color (default to black)
-        color_str = box.get('color', '#000000')
-        if color_str.startswith('#'):
-            r = int(color_str[1:3], 16)
-            g = int(color_str[3:5], 16)
-            b = int(color_str[5:7], 16)
-            color = (r, g, b)
-        else:
-            color = (0, 0, 0)  # Default to black
         
-        # Calculate box position and dimensions
-        x = int(float(box.get('x', 0)))
-        y = int(float(box.get('y', 0)))
-        width = int(float(box.get('width', 100)))
-        height = int(float(box.get('height', 50)))
+        try:
+            align = Align(box.get('align', 'left'))
+        except ValueError:
+            align = Align.LEFT
+        
+        values = {
+            'column': box.get('column'),
+            'x': int(float(box.get('x', 0)) * scale),
+            'y': int(float(box.get('y', 0)) * scale),
+            'width': int(float(box.get('width', 100)) * scale),
+            'height': int(float(box.get('height', 50)) * scale),
+            'font': get_font(font_family, font_size, bold=is_bold, italic=is_italic),
+            'font_key': (font_family.lower().replace(' ', ''), font_size, is_bold, is_italic),
+            'font_size': font_size,
+            'line_height': int(font_size * 1.2),  # Approx line height
+            'color': parse_hex_color(box.get('color', '#000000')),
+            'align': align,
+            'underline': str_to_bool(box.get('underline', False)),
+            'strikethrough': str_to_bool(box.get('strikethrough', False))
+        }
+        for name, value in values.items():
+            object.__setattr__(self, name, value)
+
+class ImageBoxPlan(_FrozenPlan):
+    """Pre-parsed geometry for an image box.
+
+    ``img_width`` and ``img_height`` are the template size; ``scale`` maps
+    the geometry onto a resized render target.
+    """
+    __slots__ = ('column', 'x', 'y', 'width', 'height')
+
+    def __init__(self, box, img_width, img_height, scale=1.0):
+        x = float(box.get('x', 0))
+        y = float(box.get('y', 0))
+        values = {
+            'column': box.get('column'),
+            'x': int(x * scale),
+            'y': int(y * scale),
+            'width': int(float(box.get('width', img_width - x)) * scale),
+            'height': int(float(box.get('height', img_height - y)) * scale)
+        }
+        for name, value in values.items():
+            object.__setattr__(self, name, value)
+
+def compile_layout(boxes, img_width, img_height, scale=1.0):
+    """Turn the raw box configs into an immutable tuple of box plans.
+
+    Box configs are in template coordinates (``img_width`` x ``img_height``);
+    pass ``scale`` to lay them out on a template resized by that factor.
+    """
+    plans = []
+    for box in boxes:
+        try:
+            if box.get('isImage', False):
+                plans.append(ImageBoxPlan(box, img_width, img_height, scale))
+            else:
+                plans.append(TextBoxPlan(box, scale))
+        except Exception as e:
+            print(f"Error compiling box for column '{box.get('column')}': {e}")
+    return tuple(plans)
+
+def draw_text_box(draw, box, text, img_width, img_height):
+    """Helper function to draw text box with proper wrapping and alignment
+
+    Returns the (left, top, right, bottom) area that was drawn on, or None.
+    """
+    try:
+        if isinstance(box, dict):
+            box = TextBoxPlan(box)
+        
+        x = box.x
+        y = box.y
+        width = box.width
+        font = box.font
+        font_size = box.font_size
+        color = box.color
         
         # Skip if outside image bounds
         if x > img_width or y > img_height:
@@ -289,27 +1146,28 @@ def draw_text_box(draw, box, text, img_width, img_height):
             return
         
         # Wrap text to fit width
-        wrapped_lines = wrap_text_to_width(draw, str(text), font, width)
+        wrapped_lines, line_widths = measure_wrapped_text(draw, str(text), font, box.font_key, width)
         
         # Calculate line height and total text height
-        line_height = int(font_size * 1.2)  # Approx line height
+        line_height = box.line_height
         total_text_height = len(wrapped_lines) * line_height
         
         # Handle vertical alignment (center text in box by default)
         start_y = y
-        if total_text_height < height:
-            start_y = y + (height - total_text_height) // 2
+        if total_text_height < box.height:
+            start_y = y + (box.height - total_text_height) // 2
+        
+        # Track the drawn area, padded for glyph overhang and decorations
+        pad = font_size
+        dirty = None
         
         # Draw each line with proper alignment
-        for i, line in enumerate(wrapped_lines):
-            # Get line width for alignment
-            line_width = draw.textlength(line, font=font)
-            
+        for i, (line, line_width) in enumerate(zip(wrapped_lines, line_widths)):
             # Calculate x position based on alignment
             line_x = x
-            if text_align == 'center':
+            if box.align is Align.CENTER:
                 line_x = x + (width - line_width) // 2
-            elif text_align == 'right':
+            elif box.align is Align.RIGHT:
                 line_x = x + (width - line_width)
             
             # Calculate y position for this line
@@ -321,58 +1179,401 @@ def draw_text_box(draw, box, text, img_width, img_height):
             
             # Draw the text
             draw.text((line_x, line_y), line, fill=color, font=font)
+            line_box = (int(line_x) - pad, line_y - pad, int(line_x + line_width) + pad, line_y + line_height + pad)
+            dirty = union_rect(dirty, line_box)
             
             # Draw underline if needed
-            if is_underline:
+            if box.underline:
                 underline_y = line_y + font_size * 0.9  # Position underline slightly below text
                 draw.line((line_x, underline_y, line_x + line_width, underline_y), fill=color, width=max(1, font_size // 20))
             
             # Draw strikethrough if needed
-            if is_strikethrough:
+            if box.strikethrough:
                 # Position strikethrough exactly in the middle of text
                 strike_y = line_y + (font_size * 0.4)  # Position strikethrough through the middle of text
                 # Make the strikethrough line a bit thicker for better visibility
                 line_thickness = max(1, font_size // 15)
                 draw.line((line_x, strike_y, line_x + line_width, strike_y), fill=color, width=line_thickness)
+        
+        return dirty
                 
     except Exception as e:
         print(f"Error drawing text box: {e}")
 
-def draw_image_box(draw, box, image_url, img_width, img_height):
-    """Helper function to draw image from URL into a box"""
+# Remote images
+#
+# Image boxes hold URLs. Before a chunk of rows is rendered, every URL it
+# references is downloaded concurrently over a pooled requests.Session and
+# the raw bytes are shipped with the chunk, so render workers never wait on
+# the network one box at a time.
+
+class ImageFetchError(Exception):
+    """A download failure that can be passed between processes."""
+
+# Per-process HTTP session, recreated after a fork
+_http_session = {'pid': None, 'session': None}
+
+def make_http_session(pool_size=10):
+    """Create a requests.Session with a connection pool of the given size."""
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+def get_http_session():
+    """Return this process's shared HTTP session."""
+    if _http_session['pid'] != os.getpid():
+        _http_session['pid'] = os.getpid()
+        _http_session['session'] = make_http_session()
+    return _http_session['session']
+
+class ImageDiskCache:
+    """Content-addressed on-disk cache for downloaded images.
+
+    Raw bytes are stored once per content digest under ``blobs/``. Each URL
+    has a small JSON record under ``urls/`` pointing at its digest together
+    with the ETag/Last-Modified validators, so a URL is only revalidated
+    (with a conditional GET) after ``ttl`` seconds. Resized variants for a
+    given box size can be stored under ``variants/``. When the directory
+    grows past ``max_bytes`` the least recently used files are evicted.
+
+    All writes go through a temporary file and os.replace(), so several
+    worker processes can share the same directory.
+    """
+
+    def __init__(self, cache_dir, max_bytes, ttl):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self._size = None
+        self._lock = threading.Lock()
+        for sub in ('blobs', 'urls', 'variants'):
+            os.makedirs(os.path.join(cache_dir, sub), exist_ok=True)
+
+    def _url_path(self, image_url):
+        key = hashlib.sha256(image_url.encode('utf-8')).hexdigest()
+        return os.path.join(self.cache_dir, 'urls', f'{key}.json')
+
+    def _blob_path(self, digest):
+        return os.path.join(self.cache_dir, 'blobs', digest)
+
+    def _variant_path(self, digest, size):
+        return os.path.join(self.cache_dir, 'variants', f'{digest}_{size[0]}x{size[1]}.png')
+
+    def _write(self, path, data):
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        except OSError:
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+            raise
+        self._grow(len(data))
+
+    def _read(self, path):
+        with open(path, 'rb') as f:
+            data = f.read()
+        # Touch the file so eviction sees it as recently used
+        os.utime(path)
+        return data
+
+    def lookup(self, image_url):
+        """Return (record, data) for a cached URL, or (None, None)."""
+        try:
+            with open(self._url_path(image_url), 'r') as f:
+                record = json.load(f)
+            return record, self._read(self._blob_path(record['digest']))
+        except (OSError, ValueError, KeyError):
+            return None, None
+
+    def is_fresh(self, record):
+        return time.time() - record.get('fetched_at', 0) < self.ttl
+
+    def store(self, image_url, data, etag=None, last_modified=None):
+        """Store downloaded bytes for a URL and return their digest.
+
+        Caching is best-effort: write errors (full disk, permissions) are
+        logged and the download is used uncached.
+        """
+        digest = hashlib.sha256(data).hexdigest()
+        blob_path = self._blob_path(digest)
+        try:
+            if not os.path.exists(blob_path):
+                self._write(blob_path, data)
+        except (OSError, ValueError) as e:
+            print(f"Warning: Could not cache image {image_url}: {e}")
+            return digest
+        self.touch(image_url, {'url': image_url, 'digest': digest, 'etag': etag, 'last_modified': last_modified})
+        return digest
+
+    def touch(self, image_url, record):
+        """Rewrite a URL record with a new fetch time (best-effort)."""
+        record = dict(record, fetched_at=time.time())
+        try:
+            self._write(self._url_path(image_url), json.dumps(record).encode('utf-8'))
+        except (OSError, ValueError) as e:
+            print(f"Warning: Could not update cache record for {image_url}: {e}")
+
+    def get_variant(self, digest, size):
+        """Return a cached resized image for (digest, size), or None."""
+        try:
+            variant = Image.open(BytesIO(self._read(self._variant_path(digest, size))))
+            variant.load()
+            return variant
+        except OSError:
+            return None
+
+    def put_variant(self, digest, size, img):
+        """Store a resized image for (digest, size)."""
+        try:
+            buffer = BytesIO()
+            img.save(buffer, format='PNG')
+            self._write(self._variant_path(digest, size), buffer.getvalue())
+        except (OSError, ValueError) as e:
+            print(f"Warning: Could not cache resized image: {e}")
+
+    def _grow(self, nbytes):
+        with self._lock:
+            if self._size is None:
+                self._size = self._scan_size()
+            self._size += nbytes
+            over_budget = self._size > self.max_bytes
+        if over_budget:
+            self.evict()
+
+    def _cache_files(self):
+        for sub in ('blobs', 'urls', 'variants'):
+            for entry in os.scandir(os.path.join(self.cache_dir, sub)):
+                if entry.is_file():
+                    yield entry
+
+    def _scan_size(self):
+        return sum(entry.stat().st_size for entry in self._cache_files())
+
+    def evict(self):
+        """Delete least recently used files until under 90% of the budget."""
+        with self._lock:
+            files = []
+            for entry in self._cache_files():
+                try:
+                    stat = entry.stat()
+                except OSError:
+                    continue
+                files.append((stat.st_mtime, stat.st_size, entry.path))
+            files.sort()
+            total = sum(size for _, size, _ in files)
+            target = self.max_bytes * 0.9
+            for _, size, path in files:
+                if total <= target:
+                    break
+                try:
+                    os.remove(path)
+                    total -= size
+                except OSError:
+                    pass
+            self._size = total
+
+# Per-process disk cache instance, created on first use
+_image_cache = {'pid': None, 'cache': None}
+
+def get_image_cache():
+    """Return this process's ImageDiskCache, or None if caching is disabled."""
+    if app.config['IMAGE_CACHE_MAX_BYTES'] <= 0:
+        return None
+    if _image_cache['pid'] != os.getpid():
+        _image_cache['pid'] = os.getpid()
+        _image_cache['cache'] = ImageDiskCache(
+            app.config['IMAGE_CACHE_DIR'],
+            app.config['IMAGE_CACHE_MAX_BYTES'],
+            app.config['IMAGE_CACHE_TTL']
+        )
+    return _image_cache['cache']
+
+def fetch_image_bytes(image_url, session=None, timeout=None):
+    """Download an image, returning its bytes or None for a non-200 response.
+
+    Responses are served from the disk cache while fresh and revalidated
+    with a conditional request once they expire.
+    """
+    if session is None:
+        session = get_http_session()
+    if timeout is None:
+        timeout = app.config['IMAGE_FETCH_TIMEOUT']
+    
+    cache = get_image_cache()
+    record, cached_data = (None, None) if cache is None else cache.lookup(image_url)
+    if cached_data is not None and cache.is_fresh(record):
+        return cached_data
+    
+    headers = {}
+    if cached_data is not None:
+        if record.get('etag'):
+            headers['If-None-Match'] = record['etag']
+        if record.get('last_modified'):
+            headers['If-Modified-Since'] = record['last_modified']
+    
+    response = session.get(image_url, timeout=timeout, headers=headers)
+    if response.status_code == 304 and cached_data is not None:
+        cache.touch(image_url, record)
+        return cached_data
+    if response.status_code != 200:
+        return None
+    if cache is not None:
+        cache.store(
+            image_url,
+            response.content,
+            etag=response.headers.get('ETag'),
+            last_modified=response.headers.get('Last-Modified')
+        )
+    return response.content
+
+class ImagePrefetcher:
+    """Download overlay images concurrently with per-host limits.
+
+    fetch_many() maps each URL to its bytes, None (non-200 response) or an
+    ImageFetchError. Recent results are kept so a logo that appears on
+    every row is only downloaded once per job.
+    """
+
+    def __init__(self, max_workers=None, per_host=None, cache_size=256):
+        if max_workers is None:
+            max_workers = app.config['IMAGE_FETCH_WORKERS']
+        if per_host is None:
+            per_host = app.config['IMAGE_FETCH_PER_HOST']
+        self.per_host = max(1, per_host)
+        self.session = make_http_session(pool_size=max_workers)
+        self._executor = ThreadPoolExecutor(max_workers=max(1, max_workers))
+        self._host_slots = {}
+        self._lock = threading.Lock()
+        self._results = LRUCache(cache_size)
+
+    def _host_slot(self, image_url):
+        host = urlsplit(image_url).netloc
+        with self._lock:
+            if host not in self._host_slots:
+                self._host_slots[host] = threading.BoundedSemaphore(self.per_host)
+            return self._host_slots[host]
+
+    def _fetch(self, image_url):
+        try:
+            with self._host_slot(image_url):
+                return fetch_image_bytes(image_url, session=self.session)
+        except Exception as e:
+            return ImageFetchError(str(e))
+
+    def fetch_many(self, urls):
+        results = {}
+        pending = {}
+        for image_url in urls:
+            if image_url in results or image_url in pending:
+                continue
+            cached = self._results.get(image_url, self)
+            if cached is not self:
+                results[image_url] = cached
+            else:
+                pending[image_url] = self._executor.submit(self._fetch, image_url)
+        for image_url, future in pending.items():
+            results[image_url] = future.result()
+            self._results.put(image_url, results[image_url])
+        return results
+
+    def close(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
+        self.session.close()
+
+# Resized overlays and their masks, keyed by (digest, box size, resample, target mode)
+_overlay_cache = LRUCache(OVERLAY_CACHE_SIZE)
+
+def prepare_overlay(image_data, box_width, box_height, target_mode):
+    """Decode, resize and split an overlay image so it can be pasted as-is.
+
+    Returns (overlay, mask) where overlay is already in ``target_mode`` and
+    mask is the alpha channel or None. Results are kept in an in-memory LRU
+    so a logo that lands in the same box on every row is only resampled
+    once per process.
+    """
+    digest = hashlib.sha256(image_data).hexdigest()
+    resample = Image.Resampling.LANCZOS
+    key = (digest, box_width, box_height, resample, target_mode)
+    prepared = _overlay_cache.get(key)
+    if prepared is not None:
+        return prepared
+    
+    overlay_img = Image.open(BytesIO(image_data))
+    
+    # Calculate dimensions while maintaining aspect ratio
+    overlay_width, overlay_height = overlay_img.size
+    scale = min(box_width/overlay_width, box_height/overlay_height)
+    new_width = int(overlay_width * scale)
+    new_height = int(overlay_height * scale)
+    
+    # Resize the overlay image, reusing a cached variant on disk if enabled
+    cache = get_image_cache() if app.config['IMAGE_CACHE_VARIANTS'] else None
+    resized = cache.get_variant(digest, (new_width, new_height)) if cache is not None else None
+    if resized is None:
+        resized = overlay_img.resize((new_width, new_height), resample)
+        if cache is not None:
+            cache.put_variant(digest, (new_width, new_height), resized)
+    overlay_img = resized
+    
+    # If the overlay has transparency, use it as mask
+    mask = None
+    if overlay_img.mode in ('RGBA', 'LA'):
+        # Extract the alpha channel as mask
+        mask = overlay_img.getchannel('A')
+        # Drop the alpha channel for pasting
+        overlay_img = overlay_img.convert('RGB')
+    # Match the base image so pasting needs no further conversion
+    if overlay_img.mode != target_mode:
+        overlay_img = overlay_img.convert(target_mode)
+    
+    prepared = (overlay_img, mask)
+    _overlay_cache.put(key, prepared)
+    return prepared
+
+def overlay_cache_stats():
+    """Return hit/miss counters for this process's resized-overlay cache."""
+    return _overlay_cache.stats()
+
+def draw_image_box(draw, box, image_url, img_width, img_height, images=None):
+    """Helper function to draw image from URL into a box
+
+    ``images`` optionally maps URLs to prefetched bytes (see ImagePrefetcher).
+    Returns (overlay, position) or (overlay, position, mask), with the
+    overlay already converted to the mode of the image being drawn on.
+    """
     try:
+        if isinstance(box, dict):
+            box = ImageBoxPlan(box, img_width, img_height)
+        
         # Get box dimensions and position
-        x = float(box['x'])
-        y = float(box['y'])
-        box_width = float(box.get('width', img_width - x))
-        box_height = float(box.get('height', img_height - y))
+        x = box.x
+        y = box.y
+        box_width = box.width
+        box_height = box.height
         
         try:
-            # Download and open the image from URL
-            response = requests.get(image_url, timeout=5)
-            if response.status_code == 200:
-                overlay_img = Image.open(BytesIO(response.content))
-                
-                # Calculate dimensions while maintaining aspect ratio
-                overlay_width, overlay_height = overlay_img.size
-                scale = min(box_width/overlay_width, box_height/overlay_height)
-                new_width = int(overlay_width * scale)
-                new_height = int(overlay_height * scale)
-                
-                # Resize the overlay image
-                overlay_img = overlay_img.resize((new_width, new_height), Image.Resampling.LANCZOS)
+            # Use the prefetched bytes if we have them, otherwise download now
+            if images is not None and image_url in images:
+                image_data = images[image_url]
+            else:
+                image_data = fetch_image_bytes(image_url)
+            if isinstance(image_data, Exception):
+                raise image_data
+            if image_data is not None:
+                overlay_img, mask = prepare_overlay(image_data, box_width, box_height, draw.mode)
                 
                 # Position image at exact box coordinates - no centering adjustment
                 # This ensures the image appears exactly where the box is placed
-                paste_x = int(x)
-                paste_y = int(y)
+                paste_x = x
+                paste_y = y
                 
-                # If the overlay has transparency, use it as mask
-                if overlay_img.mode in ('RGBA', 'LA'):
-                    # Extract the alpha channel as mask
-                    mask = overlay_img.split()[-1] if overlay_img.mode == 'RGBA' else overlay_img.split()[1]
-                    # Convert to RGB for pasting
-                    overlay_img = overlay_img.convert('RGB')
+                if mask is not None:
                     return (overlay_img, (paste_x, paste_y), mask)
                 else:
                     return (overlay_img, (paste_x, paste_y))
@@ -386,163 +1587,595 @@ def draw_image_box(draw, box, image_url, img_width, img_height):
     except Exception as e:
         print(f"Error drawing image box: {str(e)}")
 
-@app.route('/preview_combined_images', methods=['POST'])
-def preview_combined_images():
-    """Process both text and image boxes in a single template"""
-    global preview_progress
-    reset_preview_progress()
-    update_preview_progress(5, "starting")
+def union_rect(rect, other):
+    """Return the smallest (left, top, right, bottom) rect covering both."""
+    if rect is None:
+        return other
+    if other is None:
+        return rect
+    return (min(rect[0], other[0]), min(rect[1], other[1]),
+            max(rect[2], other[2]), max(rect[3], other[3]))
+
+def draw_row(img, draw, layout, row, idx=0, images=None):
+    """Draw one CSV row's boxes onto img.
+
+    Returns the list of (left, top, right, bottom) areas that were touched,
+    so callers that reuse the image can restore just those areas.
+    """
+    dirty = []
     
-    try:
-        data = request.get_json()
-        if not data:
-            reset_preview_progress()
-            return jsonify({'error': 'No data received'}), 400
-        
-        template_filename = data.get('template')
-        csv_data = data.get('csv_data', [])
-        boxes = data.get('text_boxes', [])
+    # Process each box (can be text or image)
+    for box in layout:
+        column = box.column
         
-        if not template_filename or not csv_data or not boxes:
-            reset_preview_progress()
-            return jsonify({'error': 'Missing required parameters'}), 400
+        if column not in row:
+            print(f"Warning: Column '{column}' not found in CSV row {idx}")
+            continue
         
-        template_path = os.path.join(app.config['UPLOAD_FOLDER'], template_filename)
-        if not os.path.exists(template_path):
-            reset_preview_progress()
-            return jsonify({'error': f'Template file not found: {template_filename}'}), 404
+        x, y = box.x, box.y
+        width, height = box.width, box.height
         
-        update_preview_progress(10, "preparing")
-        
-        preview_dir = os.path.join('static', 'previews')
-        os.makedirs(preview_dir, exist_ok=True)
-        # Clear previous previews
-        clear_directory(preview_dir, pattern="preview_*.png")
+        # Check if it's an image box
+        if isinstance(box, ImageBoxPlan):
+            image_url = row[column]
+            if image_url:  # Only process if URL is provided
+                # Error placeholders may spill to the right of the box
+                error_area = (x - 2, y - 2, img.width, y + height + 14)
+                try:
+                    # For image boxes, use the dedicated function
+                    result = draw_image_box(draw, box, image_url, img.width, img.height, images)
+                    if result:
+                        # The overlay already matches the image mode
+                        if len(result) == 3: # If mask is returned
+                            overlay, pos, mask = result
+                            # Paste using the mask
+                            img.paste(overlay, pos, mask)
+                        else: # No mask
+                            overlay, pos = result
+                            img.paste(overlay, pos)
+                        dirty.append((pos[0], pos[1], pos[0] + overlay.width, pos[1] + overlay.height))
+                    else:
+                        # Draw error indication
+                        draw.rectangle([(x, y), (x + width, y + height)], outline='red', width=2)
+                        draw.text((x + 5, y + 5), "Image Error", fill='red', font=get_font('Arial', 12))
+                        dirty.append(error_area)
+                except Exception as e:
+                    print(f"Error drawing image from {image_url}: {str(e)}")
+                    # Draw error box
+                    draw.rectangle([(x, y), (x + width, y + height)], outline='red', width=2)
+                    draw.text((x + 5, y + 5), f"Error: {str(e)[:30]}...", fill='red', font=get_font('Arial', 12))
+                    dirty.append(error_area)
+        else:
+            # It's a text box
+            if row[column]:  # Only draw if text is provided
+                area = draw_text_box(draw, box, row[column], img.width, img.height)
+                if area:
+                    dirty.append(area)
+    
+    return dirty
+
+def render_row(template_img, layout, row, idx=0, images=None):
+    """Render a single CSV row onto a copy of the template image.
+
+    ``layout`` is the tuple returned by compile_layout() for this template.
+    """
+    # Create a copy of template for each row
+    img = template_img.copy()
+    # Ensure image is in RGB or RGBA mode for consistent processing
+    if img.mode not in ('RGB', 'RGBA'):
+        img = img.convert('RGBA')
+    draw = ImageDraw.Draw(img)
+    draw_row(img, draw, layout, row, idx, images)
+    return img
+
+class RowCompositor:
+    """Render rows onto one reused buffer instead of copying the template.
+
+    The template is decoded and converted once. Before each row, only the
+    areas the previous row drew on are restored from the pristine template,
+    so per-row memory traffic is proportional to the box area rather than
+    the full template size. The returned image is overwritten by the next
+    call to render(), so encode it before rendering another row.
+    """
+
+    def __init__(self, template_img, layout):
+        if template_img.mode not in ('RGB', 'RGBA'):
+            template_img = template_img.convert('RGBA')
+        template_img.load()
+        self.template = template_img
+        self.layout = layout
+        self.buffer = template_img.copy()
+        self.draw = ImageDraw.Draw(self.buffer)
+        self._dirty = []
+
+    def render(self, row, idx=0, images=None):
+        for area in self._dirty:
+            area = self._clip(area)
+            if area:
+                self.buffer.paste(self.template.crop(area), area[:2])
+        self._dirty = draw_row(self.buffer, self.draw, self.layout, row, idx, images)
+        return self.buffer
+
+    def _clip(self, area):
+        left = max(0, area[0])
+        top = max(0, area[1])
+        right = min(self.buffer.width, area[2])
+        bottom = min(self.buffer.height, area[3])
+        if left >= right or top >= bottom:
+            return None
+        return (left, top, right, bottom)
+
+# Render engine
+#
+# Rows are rendered in chunks by a pool of worker processes that lives as
+# long as the web worker. Every chunk is sent with a small render spec
+# (template path, mtime and size, box configs, output settings, scale);
+# each worker loads the template from disk and compiles the layout plan
+# the first time it sees a spec and keeps the result in a small LRU, so
+# later chunks only carry their rows. Large merges thus scale with the
+# number of cores instead of pinning the request thread.
+
+# PNG encoder settings: zlib level 1 is several times faster than the default 6
+# for a slightly larger file; 'optimize' makes an extra pass for the smallest output
+PNG_PRESETS = {
+    'fast': {'compress_level': 1, 'optimize': False},
+    'default': {'compress_level': 6, 'optimize': False},
+    'small': {'compress_level': 9, 'optimize': True}
+}
+
+def png_save_options(spec=None, default_preset=None):
+    """Resolve a PNG encoder spec into keyword arguments for Image.save().
+
+    ``spec`` is a preset name, or a dict with an optional ``preset`` and
+    ``compress_level`` / ``optimize`` overrides. Raises ValueError for
+    unknown presets or out-of-range levels.
+    """
+    if default_preset is None:
+        default_preset = app.config['PNG_PRESET']
+    if spec is None or isinstance(spec, str):
+        spec = {'preset': spec}
+    if not isinstance(spec, dict):
+        raise ValueError("PNG options must be a preset name or an object")
+    
+    preset = spec.get('preset') or default_preset
+    if preset not in PNG_PRESETS:
+        raise ValueError(f"Unknown PNG preset: {preset}")
+    options = dict(PNG_PRESETS[preset])
+    
+    if spec.get('compress_level') is not None:
+        try:
+            level = int(spec['compress_level'])
+        except (TypeError, ValueError):
+            raise ValueError("compress_level must be an integer")
+        if not 0 <= level <= 9:
+            raise ValueError("compress_level must be between 0 and 9")
+        options['compress_level'] = level
+    if spec.get('optimize') is not None:
+        options['optimize'] = str_to_bool(spec['optimize'])
+    return options
+
+# Output formats: Pillow encoder, file extension and MIME type. PDF pages are
+# encoded as JPEG by the workers and embedded as-is by PdfPageWriter.
+OUTPUT_FORMATS = {
+    'png': ('PNG', '.png', 'image/png'),
+    'jpeg': ('JPEG', '.jpg', 'image/jpeg'),
+    'webp': ('WEBP', '.webp', 'image/webp'),
+    'pdf': ('JPEG', '.pdf', 'application/pdf')
+}
+FORMAT_ALIASES = {'jpg': 'jpeg'}
+
+def output_encoder(fmt=None, png=None, quality=None, dpi=None, png_preset=None):
+    """Resolve output settings into an encoder spec for render_rows().
+
+    The spec is a plain dict (so it can be stored with a job) holding the
+    format name, Pillow format, extension, MIME type, Image.save() keyword
+    arguments and, for PDF, the page resolution. Raises ValueError for
+    unknown formats or out-of-range values.
+    """
+    fmt = (fmt or app.config['OUTPUT_FORMAT']).lower()
+    fmt = FORMAT_ALIASES.get(fmt, fmt)
+    if fmt not in OUTPUT_FORMATS:
+        raise ValueError(f"Unknown output format: {fmt}")
+    pil_format, extension, mimetype = OUTPUT_FORMATS[fmt]
+    
+    if pil_format == 'PNG':
+        save_options = png_save_options(png, png_preset)
+    else:
+        try:
+            quality = int(quality if quality is not None else app.config['OUTPUT_QUALITY'])
+        except (TypeError, ValueError):
+            raise ValueError("quality must be an integer")
+        if not 1 <= quality <= 100:
+            raise ValueError("quality must be between 1 and 100")
+        save_options = {'quality': quality}
+    
+    encoder = {
+        'format': fmt,
+        'pil_format': pil_format,
+        'extension': extension,
+        'mimetype': mimetype,
+        'save_options': save_options
+    }
+    if fmt == 'pdf':
+        try:
+            encoder['dpi'] = float(dpi if dpi is not None else app.config['PDF_DPI'])
+        except (TypeError, ValueError):
+            raise ValueError("dpi must be a number")
+        if encoder['dpi'] <= 0:
+            raise ValueError("dpi must be positive")
+    return encoder
+
+def request_encoder(data, png_preset=None):
+    """Build the encoder spec from the output fields of a request payload."""
+    return output_encoder(data.get('format'), data.get('png'), data.get('quality'),
+                          data.get('dpi'), png_preset)
+
+def encode_image(img, encoder):
+    """Encode a rendered image with an encoder spec and return the bytes."""
+    if encoder['pil_format'] == 'JPEG' and img.mode not in ('RGB', 'L'):
+        # JPEG has no alpha channel; flatten transparent areas onto white
+        if img.mode in ('RGBA', 'LA') or (img.mode == 'P' and 'transparency' in img.info):
+            rgba = img.convert('RGBA')
+            flattened = Image.new('RGB', rgba.size, (255, 255, 255))
+            flattened.paste(rgba, mask=rgba.getchannel('A'))
+            img = flattened
+        else:
+            img = img.convert('RGB')
+    buffer = BytesIO()
+    img.save(buffer, format=encoder['pil_format'], **encoder['save_options'])
+    return buffer.getvalue()
+
+def scaled_size(size, scale):
+    """Pixel size of an image resized by ``scale``."""
+    return (max(1, round(size[0] * scale)), max(1, round(size[1] * scale)))
+
+def display_scale(template_size, display_width=None, display_height=None):
+    """Scale factor that fits the template into a display size (never above 1).
+
+    Either dimension may be omitted; without both the template is used as is.
+    Raises ValueError for non-positive or non-numeric sizes.
+    """
+    scales = []
+    for requested, actual in ((display_width, template_size[0]), (display_height, template_size[1])):
+        if requested is None:
+            continue
+        try:
+            requested = float(requested)
+        except (TypeError, ValueError):
+            raise ValueError("Display size must be a number")
+        if requested <= 0:
+            raise ValueError("Display size must be positive")
+        scales.append(requested / actual)
+    return min(scales + [1.0])
+
+def downscale_template(template_img, scale):
+    """Resize a decoded template by ``scale`` for low-resolution rendering."""
+    # Bilinear with a reducing gap is much faster than Lanczos on large
+    # templates and looks the same at preview sizes
+    return template_img.resize(scaled_size(template_img.size, scale), Image.Resampling.BILINEAR, reducing_gap=3.0)
+
+# Downscaled templates, keyed by (path, mtime, file size, scale)
+_template_cache = LRUCache(TEMPLATE_CACHE_SIZE)
+
+def load_scaled_template(template_path, scale):
+    """Return (downscaled template, original size), reusing earlier resizes of the same file.
+
+    The cached image is shared between requests and must not be modified.
+    """
+    stat = os.stat(template_path)
+    key = (os.path.abspath(template_path), stat.st_mtime_ns, stat.st_size, scale)
+    cached = _template_cache.get(key)
+    if cached is not None:
+        return cached
+    with Image.open(template_path) as template_img:
+        template_img.load()
+        cached = (downscale_template(template_img, scale), template_img.size)
+    _template_cache.put(key, cached)
+    return cached
+
+def template_cache_stats():
+    """Return hit/miss counters for the downscaled template cache."""
+    return _template_cache.stats()
+
+def _make_render_state(template_img, template_size, boxes, composite=True, encoder=None, scale=1.0, state=None):
+    """Compile the layout for an already decoded (and possibly downscaled) template."""
+    if state is None:
+        state = {}
+    state['template'] = template_img
+    state['layout'] = compile_layout(boxes, template_size[0], template_size[1], scale)
+    state['compositor'] = RowCompositor(template_img, state['layout']) if composite else None
+    state['encoder'] = encoder or output_encoder()
+    return state
+
+def render_spec(template_path, boxes, composite=True, encoder=None, scale=1.0):
+    """Describe a render job so any worker process can rebuild its state.
+
+    The template's modification time and size are included, so a template
+    re-uploaded under the same name gets a new spec.
+    """
+    stat = os.stat(template_path)
+    return {
+        'template': os.path.abspath(template_path),
+        'mtime_ns': stat.st_mtime_ns,
+        'size': stat.st_size,
+        'boxes': boxes,
+        'composite': composite,
+        'encoder': encoder or output_encoder(),
+        'scale': scale
+    }
+
+def build_render_state(spec):
+    """Load the template of a render spec and compile its layout."""
+    if spec['scale'] != 1.0:
+        template_img, template_size = load_scaled_template(spec['template'], spec['scale'])
+    else:
+        template_img = Image.open(spec['template'])
+        template_img.load()
+        template_size = template_img.size
+    return _make_render_state(template_img, template_size, spec['boxes'], spec['composite'],
+                              spec['encoder'], spec['scale'])
+
+# Render states of recent specs, kept in each render worker process.
+# Workers render one chunk at a time, so a cached compositor is never shared.
+_render_states = LRUCache(RENDER_STATE_CACHE_SIZE)
+
+def _worker_render_state(spec):
+    key = json.dumps(spec, sort_keys=True)
+    state = _render_states.get(key)
+    if state is None:
+        state = build_render_state(spec)
+        _render_states.put(key, state)
+    return state
+
+def _render_chunk(spec, chunk, images=None, state=None):
+    """Render a chunk of (idx, row) pairs, returning (idx, image_bytes) pairs.
+
+    Without ``state`` (in a render worker) the state for ``spec`` is looked
+    up in the per-process cache.
+    """
+    if state is None:
+        state = _worker_render_state(spec)
+    results = []
+    for idx, row in chunk:
+        if state['compositor'] is not None:
+            img = state['compositor'].render(row, idx, images)
+        else:
+            img = render_row(state['template'], state['layout'], row, idx, images)
+        results.append((idx, encode_image(img, state['encoder'])))
+    return results
+
+def _iter_row_chunks(rows, chunk_size):
+    """Group rows into lists of (idx, row) pairs without materializing them all."""
+    chunk = []
+    for idx, row in enumerate(rows):
+        chunk.append((idx, row))
+        if len(chunk) >= chunk_size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+def _chunk_image_urls(chunk, image_columns):
+    """Collect the image URLs referenced by a chunk of rows."""
+    urls = []
+    for _, row in chunk:
+        for column in image_columns:
+            image_url = row.get(column)
+            if image_url and isinstance(image_url, str):
+                urls.append(image_url)
+    return urls
+
+# Render worker pools of this process, by number of workers. Workers are
+# started through a forkserver rather than forked from the web worker,
+# whose request and job threads may hold locks (sqlite3, urllib3, logging)
+# at fork time, and the pool is kept for the life of the process.
+_render_pools = {}
+_render_pools_lock = threading.Lock()
+
+def get_render_pool(workers):
+    """Return this process's render pool with ``workers`` processes, starting it if needed."""
+    with _render_pools_lock:
+        pool = _render_pools.get(workers)
+        if pool is None or pool[0] != os.getpid():
+            executor = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('forkserver'))
+            pool = _render_pools[workers] = (os.getpid(), executor)
+        return pool[1]
+
+def discard_render_pool(workers, executor):
+    """Drop a broken render pool so the next merge starts a new one."""
+    with _render_pools_lock:
+        if _render_pools.get(workers, (None, None))[1] is executor:
+            del _render_pools[workers]
+    executor.shutdown(wait=False, cancel_futures=True)
+
+def render_rows(template_path, boxes, rows, workers=None, chunk_size=None, composite=None, encoder=None, scale=1.0):
+    """Render every row and yield (idx, image_bytes) pairs in input order.
+
+    Rows may be any iterable; they are consumed lazily and at most
+    ``workers * 2`` chunks are in flight at once on this process's shared
+    render pool. Jobs that fit in a single chunk (e.g. the interactive
+    preview) are rendered in-process. Overlay images for each chunk are downloaded
+    concurrently before the chunk is handed to a worker. ``encoder`` is an
+    output_encoder() spec; the default is PNG. A ``scale`` below 1 renders
+    on a downscaled template, with box geometry and fonts scaled to match.
+    """
+    if workers is None:
+        workers = app.config['RENDER_WORKERS']
+    if chunk_size is None:
+        chunk_size = app.config['RENDER_CHUNK_SIZE']
+    if composite is None:
+        composite = app.config['RENDER_COMPOSITE']
+    if encoder is None:
+        encoder = output_encoder()
+    workers = max(1, int(workers))
+    chunk_size = max(1, int(chunk_size))
+    
+    chunks = _iter_row_chunks(rows, chunk_size)
+    first_chunk = next(chunks, None)
+    if first_chunk is None:
+        return
+    second_chunk = next(chunks, None)
+    chunks = itertools.chain([first_chunk] if second_chunk is None else [first_chunk, second_chunk], chunks)
+    
+    image_columns = [box.get('column') for box in boxes if box.get('isImage', False)]
+    prefetcher = ImagePrefetcher() if image_columns else None
+    
+    def with_images(chunk):
+        if prefetcher is None:
+            return chunk, None
+        return chunk, prefetcher.fetch_many(_chunk_image_urls(chunk, image_columns))
+    
+    spec = render_spec(template_path, boxes, composite, encoder, scale)
+    pending = deque()
+    try:
+        if workers == 1 or second_chunk is None:
+            # A fresh state per call: request threads must not share a compositor
+            state = build_render_state(spec)
+            for chunk in chunks:
+                yield from _render_chunk(spec, *with_images(chunk), state=state)
+            return
         
-        update_preview_progress(15, "loading template")
-        template_img = Image.open(template_path)
+        executor = get_render_pool(workers)
+        try:
+            # Futures are consumed in submission order, which keeps the output
+            # deterministic regardless of which worker finishes first
+            for chunk in chunks:
+                pending.append(executor.submit(_render_chunk, spec, *with_images(chunk)))
+                if len(pending) >= workers * 2:
+                    yield from pending.popleft().result()
+            while pending:
+                yield from pending.popleft().result()
+        except BrokenProcessPool:
+            discard_render_pool(workers, executor)
+            raise
+    finally:
+        # The pool is shared, so only this call's unfinished chunks are dropped
+        for future in pending:
+            future.cancel()
+        if prefetcher is not None:
+            prefetcher.close()
+
+def preview_output(template_path, params):
+    """Work out the render scale and encoder for a preview request.
+
+    ``params`` holds the optional display size and output fields of the
+    request. Returns (template_size, scale, encoder); raises ValueError for
+    invalid values.
+    """
+    with Image.open(template_path) as template_img:
+        template_size = template_img.size
+    scale = display_scale(template_size, params.get('display_width'), params.get('display_height'))
+    if scale < 1.0 and not params.get('format'):
+        encoder = output_encoder('jpeg', quality=params.get('quality', app.config['PREVIEW_QUALITY']))
+    else:
+        encoder = request_encoder(params, app.config['PREVIEW_PNG_PRESET'])
+    if encoder['format'] == 'pdf':
+        # Preview the JPEG pages the PDF would embed
+        encoder = output_encoder('jpeg', quality=encoder['save_options']['quality'])
+    return template_size, scale, encoder
+
+@app.route('/preview_combined_images', methods=['POST'])
+def preview_combined_images():
+    """Process both text and image boxes in a single template
+
+    Send ``display_width`` and/or ``display_height`` to render a low-resolution
+    preview at (at most) that size instead of the full template resolution;
+    such previews are JPEG unless a format is requested. Send a
+    client-generated ``job_id`` to follow progress via GET /jobs/<id>.
+
+    By default previews are saved under static/previews and their URLs are
+    returned. ``inline`` skips the filesystem: ``"image"`` responds with the
+    encoded bytes of the first row's image (metadata in X-Preview-* headers),
+    ``"base64"`` returns data URIs in place of the URLs in ``preview_urls``.
+    """
+    data = request.get_json()
+    if not data:
+        return jsonify({'error': 'No data received'}), 400
+    
+    template_filename = data.get('template')
+    boxes = data.get('text_boxes', [])
+    
+    if not template_filename or not boxes or not (data.get('dataset_id') or data.get('csv_data')):
+        return jsonify({'error': 'Missing required parameters'}), 400
+    
+    template_path = os.path.join(app.config['UPLOAD_FOLDER'], template_filename)
+    if not os.path.exists(template_path):
+        return jsonify({'error': f'Template file not found: {template_filename}'}), 404
+    
+    try:
+        rows, row_count = request_rows(data)
+    except LookupError as e:
+        return jsonify({'error': str(e)}), 404
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    
+    inline = data.get('inline')
+    if inline not in (None, 'image', 'base64'):
+        return jsonify({'error': f'Unknown inline mode: {inline}'}), 400
+    
+    max_previews = 1 if inline == 'image' else app.config['PREVIEW_MAX_ROWS']
+    if row_count is not None:
+        max_previews = min(row_count, max_previews)
+    try:
+        template_size, scale, encoder = preview_output(template_path, data)
+        progress = start_request_job('preview', data.get('job_id'), max_previews)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    
+    try:
+        if inline is None:
+            preview_dir = os.path.join('static', 'previews')
+            os.makedirs(preview_dir, exist_ok=True)
+            # Clear previous previews
+            clear_directory(preview_dir, pattern="preview_*")
         
         # Generate preview images
         preview_urls = []
-        max_previews = min(len(csv_data), 10) if len(csv_data) > 10 else len(csv_data)
+        progress.update(status="generating previews")
         
-        update_preview_progress(20, "generating previews")
-        
-        for idx, row in enumerate(csv_data[:max_previews]):
-            # Calculate progress - spread from 20% to 90%
-            current_progress = 20 + (70 * (idx / max(1, max_previews - 1)))
-            update_preview_progress(current_progress, f"generating image {idx+1}/{max_previews}")
-            
-            # Create a copy of template for each row
-            img = template_img.copy()
-            # Ensure image is in RGB or RGBA mode for consistent processing
-            if img.mode not in ('RGB', 'RGBA'):
-                img = img.convert('RGBA')
-            draw = ImageDraw.Draw(img)
-            
-            # Process each box (can be text or image)
-            for box in boxes:
-                column = box.get('column')
-                
-                if column not in row:
-                    print(f"Warning: Column '{column}' not found in CSV row {idx}")
+        with closing(render_rows(template_path, boxes, itertools.islice(rows, max_previews), encoder=encoder, scale=scale)) as rendered:
+            for idx, image_bytes in rendered:
+                progress.advance(nbytes=len(image_bytes))
+                if inline == 'image':
+                    progress.complete()
+                    width, height = scaled_size(template_size, scale)
+                    headers = {
+                        'Cache-Control': 'no-store',
+                        'X-Preview-Scale': str(scale),
+                        'X-Preview-Size': f'{width}x{height}'
+                    }
+                    if row_count is not None:
+                        headers['X-Preview-Total-Rows'] = str(row_count)
+                    return Response(image_bytes, mimetype=encoder['mimetype'], headers=headers)
+                if inline == 'base64':
+                    encoded = base64.b64encode(image_bytes).decode('ascii')
+                    preview_urls.append(f"data:{encoder['mimetype']};base64,{encoded}")
                     continue
                 
-                x = float(box.get('x', 0))
-                y = float(box.get('y', 0))
-                width = float(box.get('width', 100))
-                height = float(box.get('height', 100))
+                # Save preview image
+                preview_filename = f"preview_{idx}_{int(datetime.now().timestamp() * 1000)}{encoder['extension']}"
+                preview_path = os.path.join('static', 'previews', preview_filename)
+                with open(preview_path, 'wb') as f:
+                    f.write(image_bytes)
                 
-                # Check if it's an image box
-                if box.get('isImage', False):
-                    image_url = row[column]
-                    if image_url:  # Only process if URL is provided
-                        try:
-                            # For image boxes, use the dedicated function
-                            result = draw_image_box(draw, box, image_url, img.width, img.height)
-                            if result:
-                                if len(result) == 3: # If mask is returned
-                                    overlay, pos, mask = result
-                                    # Ensure overlay is RGBA before pasting with mask
-                                    if overlay.mode != 'RGBA':
-                                        overlay = overlay.convert('RGBA')
-                                    # Paste using the mask
-                                    img.paste(overlay, pos, mask)
-                                else: # No mask
-                                    overlay, pos = result
-                                    # Ensure overlay is compatible with base image mode
-                                    if img.mode == 'RGBA' and overlay.mode != 'RGBA':
-                                        overlay = overlay.convert('RGBA')
-                                    elif img.mode == 'RGB' and overlay.mode != 'RGB':
-                                        overlay = overlay.convert('RGB')
-                                    img.paste(overlay, pos)
-                            else:
-                                # Draw error indication
-                                draw.rectangle([(x, y), (x + width, y + height)], outline='red', width=2)
-                                draw.text((x + 5, y + 5), "Image Error", fill='red', font=ImageFont.truetype(DEFAULT_FONT, 12))
-                        except Exception as e:
-                            print(f"Error drawing image from {image_url}: {str(e)}")
-                            # Draw error box
-                            draw.rectangle([(x, y), (x + width, y + height)], outline='red', width=2)
-                            draw.text((x + 5, y + 5), f"Error: {str(e)[:30]}...", fill='red', font=ImageFont.truetype(DEFAULT_FONT, 12))
-                else:
-                    # It's a text box
-                    if row[column]:  # Only draw if text is provided
-                        # Handle text styling
-                        font_size = int(box.get('fontSize', 24))
-                        font_family = box.get('fontFamily', 'Arial')
-                        # Convert hex to RGB color
-                        color_hex = box.get('color', '#000000')
-                        if not color_hex.startswith('#'):
-                            color_hex = '#000000'
-                        color = tuple(int(color_hex.lstrip('#')[i:i+2], 16) for i in (0, 2, 4))
-                        
-                        # Handle text styling
-                        bold = box.get('bold', False)
-                        italic = box.get('italic', False)
-                        underline = box.get('underline', False)
-                        strikethrough = box.get('strikethrough', False)
-                        align = box.get('align', 'left')
-                        
-                        # Create a modified box with all required parameters for draw_text_box
-                        text_box = {
-                            'x': x,
-                            'y': y,
-                            'width': width,
-                            'height': height,
-                            'fontSize': font_size,
-                            'fontFamily': font_family,
-                            'color': color_hex,
-                            'bold': str(bold).lower(),
-                            'italic': str(italic).lower(),
-                            'underline': str(underline).lower(),
-                            'strikethrough': str(strikethrough).lower(),
-                            'align': align
-                        }
-                        
-                        draw_text_box(draw, text_box, row[column], img.width, img.height)
-            
-            # Save preview image
-            preview_filename = f'preview_{idx}_{int(datetime.now().timestamp() * 1000)}.png'
-            preview_path = os.path.join('static', 'previews', preview_filename)
-            img.save(preview_path)
-            
-            # Add URL to list
-            preview_url = url_for('static', filename=f'previews/{preview_filename}', _external=False) + f"?v={int(datetime.now().timestamp())}"
-            preview_urls.append(preview_url)
-        
-        update_preview_progress(95, "finalizing")
-        time.sleep(0.5)  # Short delay to ensure frontend gets final progress update
-        update_preview_progress(100, "complete")
+                # Add URL to list
+                preview_url = url_for('static', filename=f'previews/{preview_filename}', _external=False) + f"?v={int(datetime.now().timestamp())}"
+                preview_urls.append(preview_url)
         
-        return jsonify({
+        result = {
             'preview_urls': preview_urls,
+            'total_rows': row_count,
+            'truncated': row_count is None or row_count > max_previews,
+            'scale': scale,
+            'size': scaled_size(template_size, scale),
             'message': f'Generated {len(preview_urls)} preview images'
-        })
+        }
+        progress.complete()
+        return jsonify(result)
         
     except Exception as e:
         print(f"Error in preview_combined_images: {str(e)}")
-        reset_preview_progress()
+        progress.fail(str(e))
         return jsonify({'error': str(e)}), 500
 
 def generate_unique_id(length=8):
@@ -553,19 +2186,13 @@ def generate_unique_id(length=8):
 @app.route('/download_individual', methods=['POST'])
 def download_individual():
     """Download individual preview images"""
-    global download_progress
-    reset_download_progress()
-    update_download_progress(5, "starting")
-    
     data = request.get_json()
     
     if not data or 'preview_urls' not in data:
-        reset_download_progress()
         return jsonify({'error': 'No preview URLs provided'}), 400
     
     preview_urls = data.get('preview_urls', [])
     if not preview_urls:
-        reset_download_progress()
         return jsonify({'error': 'Empty preview URLs list'}), 400
     
     try:
@@ -575,33 +2202,23 @@ def download_individual():
         download_dir = os.path.join('static', 'downloads', f'batch_{timestamp}_{unique_id}')
         os.makedirs(download_dir, exist_ok=True)
         
-        update_download_progress(15, "preparing files")
-        
         # Copy each preview image to the download directory
         file_paths = []
-        total_urls = len(preview_urls)
         
         for idx, url in enumerate(preview_urls):
-            # Calculate progress - spread from 15% to 85%
-            current_progress = 15 + (70 * (idx / max(1, total_urls - 1)))
-            update_download_progress(current_progress, f"preparing file {idx+1}/{total_urls}")
-            
             # Extract filename from URL
             filename = os.path.basename(url.split('?')[0])
             src_path = os.path.join('static', 'previews', filename)
             
-            # Create a more user-friendly filename
-            dst_filename = f'image_{idx+1}.png'
+            # Create a more user-friendly filename, keeping the preview's format
+            extension = os.path.splitext(filename)[1] or '.png'
+            dst_filename = f'image_{idx+1}{extension}'
             dst_path = os.path.join(download_dir, dst_filename)
             
             # Copy the file
             shutil.copy2(src_path, dst_path)
             file_paths.append(dst_path)
         
-        update_download_progress(90, "finalizing")
-        time.sleep(0.5)  # Short delay to ensure frontend gets final progress update
-        update_download_progress(100, "complete")
-        
         # Return the download directory information
         return jsonify({
             'download_dir': download_dir,
@@ -612,9 +2229,1020 @@ def download_individual():
         
     except Exception as e:
         print(f"Error preparing downloads: {str(e)}")
-        reset_download_progress()
         return jsonify({'error': str(e)}), 500
 
+# Image formats whose data is already compressed; deflating them again costs
+# CPU for almost no size gain
+PRECOMPRESSED_EXTENSIONS = {'.png', '.jpg', '.jpeg', '.webp', '.gif'}
+
+ARCHIVE_COMPRESSION_METHODS = {
+    'stored': zipfile.ZIP_STORED,
+    'deflated': zipfile.ZIP_DEFLATED
+}
+
+def archive_compression(filename, policy=None):
+    """Pick the zip compression method for an archive entry."""
+    policy = policy or app.config['ARCHIVE_COMPRESSION']
+    if policy in ARCHIVE_COMPRESSION_METHODS:
+        return ARCHIVE_COMPRESSION_METHODS[policy]
+    if policy != 'auto':
+        raise ValueError(f"Unknown archive compression policy: {policy}")
+    extension = os.path.splitext(filename)[1].lower()
+    return zipfile.ZIP_STORED if extension in PRECOMPRESSED_EXTENSIONS else zipfile.ZIP_DEFLATED
+
+class ZipImageWriter:
+    """Add rendered images to a zip archive as numbered image_<n> entries."""
+    def __init__(self, fileobj, extension):
+        self._zipf = zipfile.ZipFile(fileobj, 'w', zipfile.ZIP_DEFLATED)
+        self._extension = extension
+    
+    def add(self, idx, data):
+        arcname = f'image_{idx+1}{self._extension}'
+        self._zipf.writestr(arcname, data, compress_type=archive_compression(arcname))
+    
+    def close(self):
+        self._zipf.close()
+
+class PdfPageWriter:
+    """Write a multi-page PDF one JPEG page at a time.
+
+    Each page's image, content stream and page object are written as soon
+    as the page is added, and the JPEG data is embedded as-is (DCTDecode),
+    so only object offsets are kept in memory. The page tree, catalog and
+    cross-reference table are written by close(). Offsets are counted
+    locally, so the output may be an unseekable stream.
+    """
+    CATALOG_ID = 1
+    PAGES_ID = 2
+    COLORSPACES = {'L': '/DeviceGray', 'RGB': '/DeviceRGB'}
+    
+    def __init__(self, fileobj, dpi=72):
+        self._fp = fileobj
+        self._scale = 72 / dpi  # PDF user space units are 1/72 inch
+        self._position = 0
+        self._offsets = {}
+        self._page_ids = []
+        self._next_id = self.PAGES_ID + 1
+        self._closed = False
+        self._write(b'%PDF-1.4\n%\xe2\xe3\xcf\xd3\n')
+    
+    def _write(self, data):
+        self._fp.write(data)
+        self._position += len(data)
+    
+    def _write_object(self, obj_id, dictionary, stream=None):
+        self._offsets[obj_id] = self._position
+        self._write(f'{obj_id} 0 obj\n{dictionary}'.encode('ascii'))
+        if stream is not None:
+            self._write(b'\nstream\n')
+            self._write(stream)
+            self._write(b'\nendstream')
+        self._write(b'\nendobj\n')
+    
+    def add(self, idx, jpeg_bytes):
+        """Append a page showing one JPEG image at the writer's resolution."""
+        with Image.open(BytesIO(jpeg_bytes)) as img:
+            width, height, mode = img.width, img.height, img.mode
+        if img.format != 'JPEG' or mode not in self.COLORSPACES:
+            raise ValueError(f"PDF pages must be RGB or grayscale JPEG images, got {img.format} {mode}")
+        
+        image_id, content_id, page_id = self._next_id, self._next_id + 1, self._next_id + 2
+        self._next_id += 3
+        page_width = round(width * self._scale, 2)
+        page_height = round(height * self._scale, 2)
+        
+        self._write_object(image_id, (
+            f'<< /Type /XObject /Subtype /Image /Width {width} /Height {height} '
+            f'/ColorSpace {self.COLORSPACES[mode]} /BitsPerComponent 8 '
+            f'/Filter /DCTDecode /Length {len(jpeg_bytes)} >>'
+        ), jpeg_bytes)
+        content = f'q {page_width} 0 0 {page_height} 0 0 cm /Im0 Do Q'.encode('ascii')
+        self._write_object(content_id, f'<< /Length {len(content)} >>', content)
+        self._write_object(page_id, (
+            f'<< /Type /Page /Parent {self.PAGES_ID} 0 R /MediaBox [0 0 {page_width} {page_height}] '
+            f'/Resources << /XObject << /Im0 {image_id} 0 R >> >> /Contents {content_id} 0 R >>'
+        ))
+        self._page_ids.append(page_id)
+    
+    def close(self):
+        """Write the page tree, catalog, cross-reference table and trailer."""
+        if self._closed:
+            return
+        self._closed = True
+        kids = ' '.join(f'{page_id} 0 R' for page_id in self._page_ids)
+        self._write_object(self.PAGES_ID, f'<< /Type /Pages /Kids [{kids}] /Count {len(self._page_ids)} >>')
+        self._write_object(self.CATALOG_ID, f'<< /Type /Catalog /Pages {self.PAGES_ID} 0 R >>')
+        
+        xref_offset = self._position
+        size = self._next_id
+        # Every xref entry is exactly 20 bytes, including its two-byte line ending
+        entries = ['0000000000 65535 f \n']
+        entries.extend(f'{self._offsets[obj_id]:010d} 00000 n \n' for obj_id in range(1, size))
+        self._write(f'xref\n0 {size}\n{"".join(entries)}'.encode('ascii'))
+        self._write(f'trailer\n<< /Size {size} /Root {self.CATALOG_ID} 0 R >>\nstartxref\n{xref_offset}\n%%EOF\n'.encode('ascii'))
+
+def batch_extension(encoder):
+    """File extension of a batch download: one PDF document or a zip of images."""
+    return '.pdf' if encoder['format'] == 'pdf' else '.zip'
+
+def open_batch_writer(fileobj, encoder):
+    """Return the writer that collects a batch's rendered images into fileobj."""
+    if encoder['format'] == 'pdf':
+        return PdfPageWriter(fileobj, encoder['dpi'])
+    return ZipImageWriter(fileobj, encoder['extension'])
+
+def write_rendered_rows(writer, template_path, boxes, rows, progress=None, encoder=None):
+    """Render rows into a batch writer, yielding after each image is added.
+
+    ``progress`` is an optional JobProgress advanced after every image.
+    """
+    with closing(render_rows(template_path, boxes, rows, encoder=encoder)) as rendered:
+        for idx, image_bytes in rendered:
+            writer.add(idx, image_bytes)
+            if progress is not None:
+                progress.advance(nbytes=len(image_bytes))
+            yield idx
+
+def write_batch(template_path, boxes, rows, progress=None, encoder=None):
+    """Render every row straight into a new zip archive or PDF under static/downloads.
+
+    Each image is written out as soon as it is rendered, so memory use
+    stays flat no matter how many rows the batch contains. ``progress`` is
+    an optional JobProgress advanced after every image. Returns the batch
+    info used by download_batch.
+    """
+    if encoder is None:
+        encoder = output_encoder()
+    timestamp = int(datetime.now().timestamp())
+    unique_id = generate_unique_id()
+    filename = f'images_{timestamp}_{unique_id}{batch_extension(encoder)}'
+    output_path = os.path.join('static', 'downloads', filename)
+    # Write to a temporary name so download_batch never serves a partial file
+    partial_path = output_path + '.part'
+    file_count = 0
+    
+    try:
+        with open(partial_path, 'wb') as f, closing(open_batch_writer(f, encoder)) as writer:
+            for _ in write_rendered_rows(writer, template_path, boxes, rows, progress, encoder):
+                file_count += 1
+        os.replace(partial_path, output_path)
+        print(f"Created batch file: {output_path}")
+    except Exception:
+        if os.path.exists(partial_path):
+            os.remove(partial_path)
+        raise
+    
+    return {
+        'file_count': file_count,
+        'format': encoder['format'],
+        'filename': filename,
+        'timestamp': timestamp,
+        'unique_id': unique_id,
+        'download_url': f'/download_batch/{timestamp}/{unique_id}'
+    }
+
+class StreamSink:
+    """Write-only, unseekable file object that collects output in memory.
+
+    ZipFile detects that it cannot seek and writes data descriptors after
+    each entry instead of patching local headers, and PdfPageWriter only
+    ever appends, so everything written can be sent to the client as soon
+    as drain() is called.
+    """
+    def __init__(self):
+        self._chunks = []
+    
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        return len(data)
+    
+    def flush(self):
+        pass
+    
+    def drain(self):
+        """Return and forget everything written since the last drain."""
+        data = b''.join(self._chunks)
+        self._chunks.clear()
+        return data
+
+def iter_batch(template_path, boxes, rows, progress=None, encoder=None):
+    """Render every row into a zip archive or PDF and yield its bytes as they are produced.
+
+    Nothing is written to disk; each image is flushed to the client right
+    after it is rendered and the zip central directory or PDF trailer
+    follows the last one.
+    """
+    if encoder is None:
+        encoder = output_encoder()
+    sink = StreamSink()
+    file_count = 0
+    try:
+        with closing(open_batch_writer(sink, encoder)) as writer:
+            for _ in write_rendered_rows(writer, template_path, boxes, rows, progress, encoder):
+                file_count += 1
+                yield sink.drain()
+        yield sink.drain()
+    except GeneratorExit:
+        print(f"Client disconnected after {file_count} streamed images")
+        if progress is not None:
+            progress.fail("Download cancelled")
+        raise
+    except Exception as e:
+        # Headers are already sent, so the client only sees a truncated file
+        print(f"Error streaming batch: {str(e)}")
+        if progress is not None:
+            progress.fail(str(e))
+        raise
+    
+    if progress is not None:
+        progress.complete({'file_count': file_count, 'format': encoder['format']})
+
+@app.route('/render_batch', methods=['POST'])
+def render_batch():
+    """Render every CSV row and write the images straight into a zip archive (or one PDF)
+
+    Send a client-generated ``job_id`` to follow progress via GET /jobs/<id>.
+    """
+    data = request.get_json()
+    if not data:
+        return jsonify({'error': 'No data received'}), 400
+    
+    template_filename = data.get('template')
+    boxes = data.get('text_boxes', [])
+    
+    if not template_filename or not boxes or not (data.get('dataset_id') or data.get('csv_data')):
+        return jsonify({'error': 'Missing required parameters'}), 400
+    
+    template_path = os.path.join(app.config['UPLOAD_FOLDER'], template_filename)
+    if not os.path.exists(template_path):
+        return jsonify({'error': f'Template file not found: {template_filename}'}), 404
+    
+    try:
+        rows, row_count = request_rows(data)
+    except LookupError as e:
+        return jsonify({'error': str(e)}), 404
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    
+    try:
+        encoder = request_encoder(data)
+        progress = start_request_job('merge', data.get('job_id'), row_count)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    
+    try:
+        progress.update(status="rendering images")
+        batch = write_batch(template_path, boxes, rows, progress, encoder)
+        progress.complete(batch)
+        return jsonify(batch)
+        
+    except Exception as e:
+        print(f"Error rendering batch: {str(e)}")
+        progress.fail(str(e))
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/stream_batch', methods=['POST'])
+def stream_batch():
+    """Render every CSV row and stream the zip archive (or PDF) to the client as it is built
+
+    Accepts a JSON body, or a form field ``payload`` holding the same JSON so
+    a plain form submission can save the stream straight to disk. Send a
+    client-generated ``job_id`` to follow progress via GET /jobs/<id>/events.
+    """
+    if 'payload' in request.form:
+        try:
+            data = json.loads(request.form['payload'])
+        except ValueError:
+            return jsonify({'error': 'payload is not valid JSON'}), 400
+    else:
+        data = request.get_json(silent=True)
+    if not data:
+        return jsonify({'error': 'No data received'}), 400
+    if not isinstance(data, dict):
+        return jsonify({'error': 'payload must be a JSON object'}), 400
+    
+    template_filename = data.get('template')
+    boxes = data.get('text_boxes', [])
+    
+    if not template_filename or not boxes or not (data.get('dataset_id') or data.get('csv_data')):
+        return jsonify({'error': 'Missing required parameters'}), 400
+    
+    template_path = os.path.join(app.config['UPLOAD_FOLDER'], template_filename)
+    if not os.path.exists(template_path):
+        return jsonify({'error': f'Template file not found: {template_filename}'}), 404
+    
+    try:
+        rows, row_count = request_rows(data)
+    except LookupError as e:
+        return jsonify({'error': str(e)}), 404
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    
+    try:
+        encoder = request_encoder(data)
+        progress = start_request_job('merge', data.get('job_id'), row_count)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    progress.update(status="streaming images")
+    
+    timestamp = int(datetime.now().timestamp())
+    extension = batch_extension(encoder)
+    mimetype = 'application/pdf' if extension == '.pdf' else 'application/zip'
+    return Response(iter_batch(template_path, boxes, rows, progress, encoder), mimetype=mimetype, headers={
+        'Content-Disposition': f'attachment; filename="images_{timestamp}{extension}"',
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no'
+    })
+
+# Background jobs
+#
+# Large merges run outside the request: POST /jobs stores the job in a
+# SQLite database and hands it to a local thread pool, and GET /jobs/<id>
+# reports its state and progress. SQLite keeps job records visible to
+# every gunicorn worker without an external broker. Synchronous endpoints
+# can also record progress under a client-supplied job id.
+#
+# Jobs only run in the process that accepted them, so a job whose worker
+# was restarted or killed never finishes. A running job is recognised by its
+# progress timestamp going stale; a queued job records the process that
+# owns it (pid and boot id) and is only given up once that process is gone,
+# however long it waits for a free worker. Both are marked failed, and
+# finished jobs are deleted after JOB_TTL together with the batch file they
+# wrote; this happens when a process first opens the job database and
+# whenever a job is created.
+
+JOB_QUEUED = 'queued'
+JOB_RUNNING = 'running'
+JOB_COMPLETE = 'complete'
+JOB_FAILED = 'failed'
+
+# Thread pool that runs jobs accepted by this process
+_job_executor = ThreadPoolExecutor(max_workers=max(1, app.config['JOB_WORKERS']))
+
+# Job databases whose schema this process has already checked
+_jobs_db_ready = set()
+
+def jobs_db():
+    """Open a connection to the job database, creating the schema if needed."""
+    db_path = app.config['JOBS_DB']
+    os.makedirs(os.path.dirname(db_path), exist_ok=True)
+    conn = sqlite3.connect(db_path, timeout=30)
+    conn.row_factory = sqlite3.Row
+    if db_path in _jobs_db_ready:
+        return conn
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS jobs (
+            id TEXT PRIMARY KEY,
+            kind TEXT NOT NULL,
+            state TEXT NOT NULL,
+            params TEXT NOT NULL,
+            result TEXT,
+            error TEXT,
+            created_at REAL NOT NULL,
+            started_at REAL,
+            finished_at REAL,
+            status TEXT,
+            rows_done INTEGER NOT NULL DEFAULT 0,
+            rows_total INTEGER,
+            bytes_written INTEGER NOT NULL DEFAULT 0,
+            updated_at REAL,
+            owner_pid INTEGER,
+            owner_boot TEXT
+        )
+    """)
+    expire_jobs(conn)
+    conn.commit()
+    _jobs_db_ready.add(db_path)
+    return conn
+
+@lru_cache(maxsize=None)
+def boot_id():
+    """Identify the current boot, so pids recorded before a reboot are not trusted."""
+    try:
+        with open('/proc/sys/kernel/random/boot_id', 'r') as f:
+            return f.read().strip()
+    except OSError:
+        return None
+
+def job_owner_alive(owner_pid, owner_boot):
+    """Whether the process that queued a job may still run it."""
+    if owner_pid is None:
+        return False
+    if owner_boot != boot_id():
+        return False
+    if owner_pid == os.getpid():
+        return True
+    if os.name != 'posix':
+        # os.kill() would terminate the process on Windows
+        return True
+    try:
+        os.kill(owner_pid, 0)
+    except ProcessLookupError:
+        return False
+    except OSError:
+        # The pid exists but belongs to another user
+        pass
+    return True
+
+def expire_jobs(conn, now=None):
+    """Fail abandoned unfinished jobs and delete old finished ones (caller commits)."""
+    now = time.time() if now is None else now
+    error = 'Job was interrupted: its worker process stopped'
+    conn.execute(
+        "UPDATE jobs SET state = ?, status = 'failed', error = ?, finished_at = ? "
+        "WHERE state = ? AND COALESCE(updated_at, started_at, created_at) < ?",
+        (JOB_FAILED, error, now, JOB_RUNNING, now - app.config['JOB_STALE_AFTER'])
+    )
+    queued = conn.execute(
+        "SELECT id, owner_pid, owner_boot FROM jobs WHERE state = ?", (JOB_QUEUED,)
+    ).fetchall()
+    orphaned = [row['id'] for row in queued if not job_owner_alive(row['owner_pid'], row['owner_boot'])]
+    conn.executemany(
+        "UPDATE jobs SET state = ?, status = 'failed', error = ?, finished_at = ? WHERE id = ? AND state = ?",
+        [(JOB_FAILED, error, now, job_id, JOB_QUEUED) for job_id in orphaned]
+    )
+    cutoff = now - app.config['JOB_TTL']
+    pruned = conn.execute(
+        "SELECT result FROM jobs WHERE state = ? AND result IS NOT NULL AND COALESCE(finished_at, created_at) < ?",
+        (JOB_COMPLETE, cutoff)
+    ).fetchall()
+    conn.execute(
+        "DELETE FROM jobs WHERE state IN (?, ?) AND COALESCE(finished_at, created_at) < ?",
+        (JOB_COMPLETE, JOB_FAILED, cutoff)
+    )
+    for row in pruned:
+        remove_job_output(json.loads(row['result']))
+
+def remove_job_output(result):
+    """Delete the batch file a finished job wrote under static/downloads, if any."""
+    filename = result.get('filename') if isinstance(result, dict) else None
+    if not filename:
+        return
+    try:
+        os.remove(os.path.join('static', 'downloads', os.path.basename(filename)))
+    except FileNotFoundError:
+        pass
+    except OSError as e:
+        print(f"Warning: Could not remove output of expired job: {e}")
+
+def create_job(kind, params, job_id=None, state=JOB_QUEUED, rows_total=None):
+    """Record a new job and return its id."""
+    if job_id is None:
+        job_id = generate_unique_id(16)
+    now = time.time()
+    with closing(jobs_db()) as conn, conn:
+        # Clean up while we hold a write transaction anyway
+        expire_jobs(conn, now)
+        conn.execute(
+            "INSERT INTO jobs (id, kind, state, params, created_at, started_at, rows_total, updated_at, "
+            "owner_pid, owner_boot) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            (job_id, kind, state, json.dumps(params), now,
+             now if state == JOB_RUNNING else None, rows_total, now, os.getpid(), boot_id())
+        )
+    return job_id
+
+def update_job(job_id, expect_state=None, **fields):
+    """Update columns of a job record and return whether it was updated.
+    
+    With ``expect_state`` the record is only updated while the job is in
+    that state.
+    """
+    columns = ', '.join(f'{name} = ?' for name in fields)
+    with closing(jobs_db()) as conn, conn:
+        if expect_state is None:
+            cursor = conn.execute(f"UPDATE jobs SET {columns} WHERE id = ?", (*fields.values(), job_id))
+        else:
+            cursor = conn.execute(
+                f"UPDATE jobs SET {columns} WHERE id = ? AND state = ?",
+                (*fields.values(), job_id, expect_state)
+            )
+    return cursor.rowcount == 1
+
+def claim_job(job_id):
+    """Move a queued job to running; False if it is no longer queued (e.g. expired)."""
+    now = time.time()
+    with closing(jobs_db()) as conn, conn:
+        cursor = conn.execute(
+            "UPDATE jobs SET state = ?, started_at = ?, updated_at = ? WHERE id = ? AND state = ?",
+            (JOB_RUNNING, now, now, job_id, JOB_QUEUED)
+        )
+    return cursor.rowcount == 1
+
+def get_job(job_id, with_params=True, conn=None):
+    """Return a job record as a dict, or None if it does not exist.
+    
+    Pass with_params=False to skip loading the (possibly large) job input,
+    and ``conn`` to reuse an open job database connection.
+    """
+    with closing(jobs_db()) if conn is None else nullcontext(conn) as conn:
+        if with_params:
+            row = conn.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        else:
+            row = conn.execute("""
+                SELECT id, kind, state, result, error, created_at, started_at, finished_at,
+                       status, rows_done, rows_total, bytes_written, updated_at
+                FROM jobs WHERE id = ?
+            """, (job_id,)).fetchone()
+    if row is None:
+        return None
+    job = dict(row)
+    if with_params:
+        job['params'] = json.loads(job['params'])
+    job['result'] = json.loads(job['result']) if job['result'] else None
+    return job
+
+class JobNotRunningError(Exception):
+    """The job is no longer running (it was expired or pruned), so its work should stop."""
+
+class JobProgress:
+    """Progress counters for one job, written to the job store periodically.
+
+    Writes are throttled to one every ``interval`` seconds; state changes
+    (complete/fail) are always written. Writes only apply while the job is
+    running: progress updates for a job that was meanwhile expired raise
+    JobNotRunningError, and complete/fail return False. A JobProgress
+    without a job id accepts every call and records nothing, so endpoints
+    can use it unconditionally.
+    """
+
+    def __init__(self, job_id, rows_total=None, interval=0.25):
+        self.job_id = job_id
+        self.rows_total = rows_total
+        self.rows_done = 0
+        self.bytes_written = 0
+        self.status = None
+        self.interval = interval
+        self._last_flush = 0
+
+    def update(self, status=None, rows_total=None, force=False):
+        if status is not None:
+            self.status = status
+        if rows_total is not None:
+            self.rows_total = rows_total
+        self.flush(force=force or status is not None)
+
+    def advance(self, rows=1, nbytes=0):
+        self.rows_done += rows
+        self.bytes_written += nbytes
+        self.flush()
+
+    def flush(self, force=False, **fields):
+        if self.job_id is None:
+            return
+        now = time.time()
+        if not force and now - self._last_flush < self.interval:
+            return
+        self._last_flush = now
+        updated = update_job(
+            self.job_id,
+            expect_state=JOB_RUNNING,
+            status=self.status,
+            rows_done=self.rows_done,
+            rows_total=self.rows_total,
+            bytes_written=self.bytes_written,
+            updated_at=now,
+            **fields
+        )
+        if not updated:
+            raise JobNotRunningError(f'Job {self.job_id} is no longer running')
+
+    def complete(self, result=None):
+        self.status = 'complete'
+        return self._finish(state=JOB_COMPLETE, result=json.dumps(result))
+
+    def fail(self, error):
+        self.status = 'failed'
+        return self._finish(state=JOB_FAILED, error=error)
+
+    def _finish(self, **fields):
+        try:
+            self.flush(force=True, finished_at=time.time(), **fields)
+        except JobNotRunningError:
+            print(f"Not recording the outcome of job {self.job_id}: it is no longer running")
+            return False
+        return True
+
+def start_request_job(kind, job_id, rows_total):
+    """Create a running job record so a synchronous request can report progress.
+
+    Returns a JobProgress; when no job id was supplied it records nothing.
+    Raises ValueError for malformed or already used ids.
+    """
+    if not job_id:
+        return JobProgress(None)
+    if not isinstance(job_id, str) or not job_id.isalnum() or len(job_id) > 64:
+        raise ValueError('job_id must be up to 64 letters and digits')
+    try:
+        create_job(kind, {}, job_id=job_id, state=JOB_RUNNING, rows_total=rows_total)
+    except sqlite3.IntegrityError:
+        raise ValueError(f'Job {job_id} already exists')
+    return JobProgress(job_id, rows_total)
+
+def run_merge_job(job_id):
+    """Execute a queued merge job and store its result."""
+    if not claim_job(job_id):
+        print(f"Skipping job {job_id}: no longer queued")
+        return
+    job = get_job(job_id)
+    params = job['params']
+    progress = JobProgress(job_id, job['rows_total'])
+    try:
+        rows, _ = request_rows(params)
+        progress.update(status="rendering images")
+        template_path = os.path.join(app.config['UPLOAD_FOLDER'], params['template'])
+        result = write_batch(template_path, params['text_boxes'], rows, progress, params['encoder'])
+        if not progress.complete(result):
+            # Nobody can download the result of a job that was given up on
+            remove_job_output(result)
+    except JobNotRunningError as e:
+        print(f"Stopped job {job_id}: {str(e)}")
+    except Exception as e:
+        print(f"Error in job {job_id}: {str(e)}")
+        progress.fail(str(e))
+
+def job_progress(job):
+    """Derive percent, throughput and ETA from a job record."""
+    rows_done = job['rows_done'] or 0
+    rows_total = job['rows_total']
+    if job['state'] == JOB_COMPLETE:
+        percent = 100
+    elif rows_total:
+        percent = round(100 * rows_done / rows_total, 1)
+    else:
+        percent = 0
+    
+    rows_per_sec = None
+    eta_seconds = None
+    if job['started_at'] and rows_done:
+        end = job['finished_at'] or job['updated_at'] or time.time()
+        elapsed = max(end - job['started_at'], 1e-6)
+        rows_per_sec = round(rows_done / elapsed, 2)
+        if rows_total and job['state'] == JOB_RUNNING:
+            eta_seconds = round(max(rows_total - rows_done, 0) / (rows_done / elapsed), 1)
+    
+    return {
+        'status': job['status'],
+        'rows_done': rows_done,
+        'rows_total': rows_total,
+        'bytes_written': job['bytes_written'] or 0,
+        'percent': percent,
+        'rows_per_sec': rows_per_sec,
+        'eta_seconds': eta_seconds
+    }
+
+def job_summary(job):
+    """Public view of a job record (without its input parameters)."""
+    return {
+        'id': job['id'],
+        'kind': job['kind'],
+        'state': job['state'],
+        'created_at': job['created_at'],
+        'started_at': job['started_at'],
+        'finished_at': job['finished_at'],
+        'progress': job_progress(job),
+        'result': job['result'],
+        'error': job['error']
+    }
+
+@app.route('/jobs', methods=['POST'])
+def submit_job():
+    """Queue a merge job and return its id immediately"""
+    data = request.get_json()
+    if not data:
+        return jsonify({'error': 'No data received'}), 400
+    
+    template_filename = data.get('template')
+    boxes = data.get('text_boxes', [])
+    
+    if not template_filename or not boxes or not (data.get('dataset_id') or data.get('csv_data')):
+        return jsonify({'error': 'Missing required parameters'}), 400
+    
+    template_path = os.path.join(app.config['UPLOAD_FOLDER'], template_filename)
+    if not os.path.exists(template_path):
+        return jsonify({'error': f'Template file not found: {template_filename}'}), 404
+    
+    try:
+        rows, row_count = request_rows(data)
+    except LookupError as e:
+        return jsonify({'error': str(e)}), 404
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    
+    try:
+        encoder = request_encoder(data)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    
+    params = {
+        'template': template_filename,
+        'text_boxes': boxes,
+        'encoder': encoder
+    }
+    if data.get('dataset_id'):
+        # The job reads its rows from the stored dataset when it runs
+        params.update(dataset_id=data['dataset_id'], row_start=data.get('row_start'), row_end=data.get('row_end'))
+    else:
+        params['csv_data'] = rows
+    job_id = create_job('merge', params, rows_total=row_count)
+    _job_executor.submit(run_merge_job, job_id)
+    
+    return jsonify(job_summary(get_job(job_id, with_params=False))), 202
+
+@app.route('/jobs/<string:job_id>')
+def job_status(job_id):
+    """Report the state, progress and result of a job"""
+    job = get_job(job_id, with_params=False)
+    if job is None:
+        return jsonify({'error': 'Job not found'}), 404
+    return jsonify(job_summary(job))
+
+def sse_event(event, data):
+    """Format one Server-Sent Events message with a JSON payload."""
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+def iter_job_events(job_id, interval=None, wait=None, keepalive=15, stall=None):
+    """Yield SSE messages for a job until it completes or fails.
+    
+    The job store is checked every `interval` seconds and a message is only
+    sent when the record changed: a 'rows' event for the rows finished since
+    the last message, then a 'progress' event with the job summary. The stream
+    ends with a 'complete' or 'failed' event. Jobs that do not exist yet (the
+    client may subscribe before submitting) are waited for up to `wait` seconds,
+    and a running job whose record has not changed for `stall` seconds is
+    reported as failed, so an abandoned job does not hold the stream open
+    forever. Queued jobs only get keepalives while they wait.
+    """
+    interval = app.config['JOB_EVENTS_INTERVAL'] if interval is None else interval
+    wait = app.config['JOB_EVENTS_WAIT'] if wait is None else wait
+    stall = app.config['JOB_EVENTS_STALL'] if stall is None else stall
+    deadline = time.time() + wait
+    last_seen = None
+    last_change = time.time()
+    rows_sent = 0
+    last_sent = time.time()
+    
+    with closing(jobs_db()) as conn:
+        while True:
+            job = get_job(job_id, with_params=False, conn=conn)
+            if job is None:
+                if time.time() >= deadline:
+                    yield sse_event('failed', {'id': job_id, 'error': 'Job not found'})
+                    return
+            else:
+                seen = (job['state'], job['status'], job['rows_done'], job['updated_at'])
+                if seen != last_seen:
+                    last_seen = seen
+                    last_change = time.time()
+                    summary = job_summary(job)
+                    rows_done = summary['progress']['rows_done']
+                    if rows_done > rows_sent:
+                        # Rows finish in order, so new completions are one contiguous range
+                        yield sse_event('rows', {'id': job_id, 'start': rows_sent, 'end': rows_done})
+                        rows_sent = rows_done
+                    yield sse_event('progress', summary)
+                    last_sent = time.time()
+                    
+                    if job['state'] == JOB_COMPLETE:
+                        yield sse_event('complete', summary)
+                        return
+                    if job['state'] == JOB_FAILED:
+                        yield sse_event('failed', summary)
+                        return
+                elif job['state'] == JOB_RUNNING and time.time() - last_change >= stall:
+                    # Queued jobs wait for a free worker without updating their record
+                    yield sse_event('failed', dict(job_summary(job), error='Job stopped making progress'))
+                    return
+            
+            if time.time() - last_sent >= keepalive:
+                # Comment line keeps proxies from closing an idle stream
+                yield ": keepalive\n\n"
+                last_sent = time.time()
+            time.sleep(interval)
+
+@app.route('/jobs/<string:job_id>/events')
+def job_events(job_id):
+    """Stream a job's progress as Server-Sent Events"""
+    return Response(iter_job_events(job_id), mimetype='text/event-stream', headers={
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no'  # Disable response buffering in nginx
+    })
+
+# Preview sessions
+#
+# POST /sessions stores a merge's template name, box layout and CSV rows
+# (or a reference to a stored dataset) once; GET /sessions/<id>/preview/<row>
+# then renders a single row from the stored data, so paging through records
+# sends only a row index. Sessions
+# never change after creation, so a preview's ETag only has to cover the
+# session, row, template file and output settings, and a browser revisiting
+# a row gets a 304 without anything being rendered.
+
+# Session databases whose schema this process has already checked
+_sessions_db_ready = set()
+
+def sessions_db():
+    """Open a connection to the session database, creating the schema if needed."""
+    db_path = app.config['SESSIONS_DB']
+    os.makedirs(os.path.dirname(db_path), exist_ok=True)
+    conn = sqlite3.connect(db_path, timeout=30)
+    conn.row_factory = sqlite3.Row
+    if db_path in _sessions_db_ready:
+        return conn
+    conn.executescript("""
+        CREATE TABLE IF NOT EXISTS sessions (
+            id TEXT PRIMARY KEY,
+            template TEXT NOT NULL,
+            boxes TEXT NOT NULL,
+            row_count INTEGER NOT NULL,
+            created_at REAL NOT NULL,
+            dataset_id TEXT,
+            row_start INTEGER NOT NULL DEFAULT 0,
+            row_end INTEGER
+        );
+        CREATE TABLE IF NOT EXISTS session_rows (
+            session_id TEXT NOT NULL,
+            idx INTEGER NOT NULL,
+            data TEXT NOT NULL,
+            PRIMARY KEY (session_id, idx)
+        ) WITHOUT ROWID;
+    """)
+    conn.commit()
+    _sessions_db_ready.add(db_path)
+    return conn
+
+def create_session(template, boxes, rows, row_count, dataset_id=None, row_start=0, row_end=None):
+    """Store a session's template name, layout and rows, and return its id.
+
+    Sessions over a stored dataset keep only the dataset id and their row
+    range (``row_end`` None for the rest of the dataset); ``rows`` is then
+    not read and the row count is looked up from the dataset when needed.
+    """
+    session_id = generate_unique_id(16)
+    now = time.time()
+    with closing(sessions_db()) as conn, conn:
+        # Drop expired sessions while we hold a write transaction anyway
+        expired = [row['id'] for row in conn.execute(
+            "SELECT id FROM sessions WHERE created_at < ?", (now - app.config['SESSION_TTL'],))]
+        for expired_id in expired:
+            conn.execute("DELETE FROM session_rows WHERE session_id = ?", (expired_id,))
+            conn.execute("DELETE FROM sessions WHERE id = ?", (expired_id,))
+        
+        conn.execute(
+            "INSERT INTO sessions (id, template, boxes, row_count, created_at, dataset_id, row_start, row_end) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            (session_id, template, json.dumps(boxes), row_count or 0, now, dataset_id, row_start, row_end)
+        )
+        if dataset_id is None:
+            conn.executemany(
+                "INSERT INTO session_rows (session_id, idx, data) VALUES (?, ?, ?)",
+                ((session_id, idx, json.dumps(row)) for idx, row in enumerate(rows))
+            )
+    return session_id
+
+def get_session(session_id):
+    """Return a live session (without its rows) as a dict, or None."""
+    with closing(sessions_db()) as conn:
+        row = conn.execute("SELECT * FROM sessions WHERE id = ?", (session_id,)).fetchone()
+    if row is None or row['created_at'] < time.time() - app.config['SESSION_TTL']:
+        return None
+    session = dict(row)
+    session['boxes'] = json.loads(session['boxes'])
+    return session
+
+def session_row_count(session):
+    """Number of rows a session covers, or None while its dataset is still being parsed."""
+    if session['dataset_id'] is None:
+        return session['row_count']
+    dataset = Dataset.open(session['dataset_id'])
+    if dataset is None:
+        return session['row_count']
+    if not dataset.complete and session['row_end'] is None:
+        return None
+    start, stop = row_range(session, dataset.row_count if dataset.complete else None)
+    return max(stop - start, 0)
+
+def get_session_row(session, idx):
+    """Return one CSV row of a session, or None.
+
+    Rows of a dataset that is still being parsed are waited for.
+    """
+    if session['dataset_id'] is not None:
+        dataset = Dataset.open(session['dataset_id'])
+        if dataset is None:
+            return None
+        start = session['row_start'] + idx
+        return next(dataset.iter_rows(start, start + 1), None)
+    
+    with closing(sessions_db()) as conn:
+        row = conn.execute(
+            "SELECT data FROM session_rows WHERE session_id = ? AND idx = ?", (session['id'], idx)
+        ).fetchone()
+    return json.loads(row['data']) if row is not None else None
+
+def session_preview_url(session_id, idx):
+    """URL of the preview image for one row of a session."""
+    return url_for('session_preview', session_id=session_id, idx=idx)
+
+@app.route('/sessions', methods=['POST'])
+def submit_session():
+    """Store the rows and layout of a merge for on-demand row previews"""
+    data = request.get_json()
+    if not data:
+        return jsonify({'error': 'No data received'}), 400
+    
+    template_filename = data.get('template')
+    boxes = data.get('text_boxes', [])
+    
+    if not template_filename or not boxes or not (data.get('dataset_id') or data.get('csv_data')):
+        return jsonify({'error': 'Missing required parameters'}), 400
+    
+    template_path = os.path.join(app.config['UPLOAD_FOLDER'], template_filename)
+    if not os.path.exists(template_path):
+        return jsonify({'error': f'Template file not found: {template_filename}'}), 404
+    
+    try:
+        rows, row_count = request_rows(data)
+    except LookupError as e:
+        return jsonify({'error': str(e)}), 404
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    
+    if data.get('dataset_id'):
+        row_start, row_end = row_range(data, None)
+        session_id = create_session(template_filename, boxes, None, row_count,
+                                    dataset_id=data['dataset_id'], row_start=row_start, row_end=row_end)
+    else:
+        session_id = create_session(template_filename, boxes, rows, row_count)
+    return jsonify({
+        'id': session_id,
+        'row_count': row_count,
+        'preview_url': session_preview_url(session_id, 0)
+    }), 201
+
+@app.route('/sessions/<string:session_id>')
+def session_status(session_id):
+    """Describe a preview session"""
+    session = get_session(session_id)
+    if session is None:
+        return jsonify({'error': 'Session not found'}), 404
+    return jsonify({
+        'id': session['id'],
+        'template': session['template'],
+        'row_count': session_row_count(session),
+        'created_at': session['created_at'],
+        'expires_at': session['created_at'] + app.config['SESSION_TTL']
+    })
+
+@app.route('/sessions/<string:session_id>/preview/<int:idx>')
+def session_preview(session_id, idx):
+    """Render one row of a session as an image
+
+    Accepts the preview query parameters ``display_width``, ``display_height``,
+    ``format``, ``quality`` and ``png``. Responses carry an ETag and must be
+    revalidated, so a repeat request for an unchanged row returns 304.
+    """
+    session = get_session(session_id)
+    if session is None:
+        return jsonify({'error': 'Session not found'}), 404
+    row_count = session_row_count(session)
+    if row_count is not None and not 0 <= idx < row_count:
+        return jsonify({'error': f"Row {idx} out of range (0-{row_count - 1})"}), 404
+    
+    template_path = os.path.join(app.config['UPLOAD_FOLDER'], session['template'])
+    if not os.path.exists(template_path):
+        return jsonify({'error': f"Template file not found: {session['template']}"}), 404
+    
+    try:
+        template_size, scale, encoder = preview_output(template_path, request.args)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    
+    # Templates are re-uploaded under the same name, so the ETag includes
+    # the file's modification time and size
+    stat = os.stat(template_path)
+    etag = hashlib.sha256(json.dumps(
+        [session_id, idx, stat.st_mtime_ns, stat.st_size, scale, encoder], sort_keys=True
+    ).encode('utf-8')).hexdigest()[:32]
+    headers = {'Cache-Control': 'private, no-cache'}
+    if etag in request.if_none_match:
+        response = Response(status=304, headers=headers)
+        response.set_etag(etag)
+        return response
+    
+    row = get_session_row(session, idx)
+    if row is None:
+        return jsonify({'error': 'Session data is no longer available'}), 404
+    try:
+        with closing(render_rows(template_path, session['boxes'], [row], encoder=encoder, scale=scale)) as rendered:
+            _, image_bytes = next(rendered)
+    except Exception as e:
+        print(f"Error rendering session preview: {str(e)}")
+        return jsonify({'error': str(e)}), 500
+    
+    response = Response(image_bytes, mimetype=encoder['mimetype'], headers=headers)
+    response.set_etag(etag)
+    return response
+
 def delayed_file_cleanup(zip_path, download_dir, delay=30):
     """Clean up files after a delay to allow for re-downloads."""
     def cleanup_task():
@@ -647,13 +3275,21 @@ def download_batch(timestamp, unique_id):
     """Serve a batch zip file for download with unique identifier"""
     download_dir = os.path.join('static', 'downloads', f'batch_{timestamp}_{unique_id}')
     
-    if not os.path.exists(download_dir):
-        return "Download batch not found", 404
-    
     # Create a zip file with unique name
     zip_filename = f'images_{timestamp}_{unique_id}.zip'
     zip_path = os.path.join('static', 'downloads', zip_filename)
     
+    # Rendered PDF batches are served as they are
+    pdf_filename = f'images_{timestamp}_{unique_id}.pdf'
+    pdf_path = os.path.join('static', 'downloads', pdf_filename)
+    if os.path.exists(pdf_path):
+        delayed_file_cleanup(pdf_path, download_dir)
+        return send_file(pdf_path, as_attachment=True, download_name=pdf_filename)
+    
+    # Batches from /render_batch only exist as a zip file
+    if not os.path.exists(download_dir) and not os.path.exists(zip_path):
+        return "Download batch not found", 404
+    
     try:
         # Only create the zip if it doesn't already exist
         if not os.path.exists(zip_path):
@@ -662,7 +3298,7 @@ def download_batch(timestamp, unique_id):
                     for file in files:
                         file_path = os.path.join(root, file)
                         arcname = os.path.relpath(file_path, download_dir)
-                        zipf.write(file_path, arcname=arcname)
+                        zipf.write(file_path, arcname=arcname, compress_type=archive_compression(arcname))
             print(f"Created zip file: {zip_path}")
         else:
             print(f"Using existing zip file: {zip_path}")
@@ -687,43 +3323,6 @@ def clear_directory(directory_path, pattern="*.png"):
         except OSError as e:
             print(f"Error removing file {f}: {e.strerror}")
 
-# Progress tracking routes
-@app.route('/preview_progress')
-def get_preview_progress():
-    """Return the current preview generation progress"""
-    return jsonify(preview_progress)
-
-@app.route('/download_progress')
-def get_download_progress():
-    """Return the current download preparation progress"""
-    return jsonify(download_progress)
-
-# Reset preview progress
-def reset_preview_progress():
-    """Reset the preview progress to initial state"""
-    global preview_progress
-    preview_progress = {"percent": 0, "status": "idle"}
-
-# Reset download progress
-def reset_download_progress():
-    """Reset the download progress to initial state"""
-    global download_progress
-    download_progress = {"percent": 0, "status": "idle"}
-
-# Update preview progress
-def update_preview_progress(percent, status="processing"):
-    """Update the preview progress"""
-    global preview_progress
-    preview_progress["percent"] = percent
-    preview_progress["status"] = status
-
-# Update download progress
-def update_download_progress(percent, status="processing"):
-    """Update the download progress"""
-    global download_progress
-    download_progress["percent"] = percent
-    download_progress["status"] = status
-
 if __name__ == '__main__':
     # For development
     app.run(debug=True) 
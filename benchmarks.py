@@ -0,0 +1,213 @@
+"""Micro-benchmarks for the merge pipeline.
+
+Run from the project root, e.g.:
+
+    python benchmarks.py wrap
+    python benchmarks.py zip --rows 300
+    python benchmarks.py csv --rows 100000 1000000
+"""
+import argparse
+import csv
+import io
+import os
+import random
+import tempfile
+import time
+import tracemalloc
+import zipfile
+
+from PIL import Image, ImageDraw
+
+import app
+
+WORDS = ('the annual conference of regional engineering departments will be '
+         'held at the main auditorium with keynote speakers workshops and '
+         'networking sessions for all registered participants').split()
+
+def legacy_wrap_text_to_width(draw, text, font, max_width):
+    """The original quadratic wrap, kept here as the benchmark baseline."""
+    words = text.split()
+    lines = []
+    current_line = []
+
+    if not words:
+        return []
+
+    for word in words:
+        test_line = current_line + [word]
+        test_width = draw.textlength(' '.join(test_line), font=font)
+
+        if test_width <= max_width:
+            current_line.append(word)
+        else:
+            if current_line:
+                lines.append(' '.join(current_line))
+                current_line = [word]
+            else:
+                chars = list(word)
+                current_chars = []
+                for char in chars:
+                    test_chars = current_chars + [char]
+                    if draw.textlength(''.join(test_chars), font=font) <= max_width:
+                        current_chars.append(char)
+                    else:
+                        if current_chars:
+                            lines.append(''.join(current_chars))
+                            current_chars = [char]
+                        else:
+                            lines.append(char)
+                if current_chars:
+                    current_line = [''.join(current_chars)]
+
+    if current_line:
+        lines.append(' '.join(current_line))
+
+    return lines
+
+def time_call(func, *args, repeat=3):
+    """Return the best wall-clock time of several runs."""
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func(*args)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+def bench_wrap(args):
+    """Compare the legacy and incremental word-wrap on paragraph-length cells."""
+    random.seed(0)
+    draw = ImageDraw.Draw(Image.new('RGB', (1, 1)))
+    font = app.get_font('Arial', 24)
+
+    print(f"{'words':>6} {'width':>6} {'legacy ms':>10} {'new ms':>8} {'speedup':>8}")
+    for word_count in (20, 80, 250):
+        cells = [' '.join(random.choice(WORDS) for _ in range(word_count))
+                 for _ in range(args.cells)]
+        for width in (300, 1200):
+            def run(wrap):
+                for text in cells:
+                    wrap(draw, text, font, width)
+            legacy = time_call(run, legacy_wrap_text_to_width)
+            new = time_call(run, app.wrap_text_to_width)
+            print(f"{word_count:>6} {width:>6} {legacy * 1000:>10.1f} {new * 1000:>8.1f} {legacy / new:>7.1f}x")
+
+def make_certificate_template(path, width=1600, height=1200):
+    """Save a certificate-like template: gradient background, border and a seal."""
+    img = Image.new('RGB', (width, height))
+    draw = ImageDraw.Draw(img)
+    for y in range(height):
+        shade = 235 + 20 * y // height
+        draw.line([(0, y), (width, y)], fill=(shade, shade - 10, shade - 30))
+    draw.rectangle([30, 30, width - 30, height - 30], outline=(120, 90, 30), width=12)
+    draw.ellipse([width - 330, height - 330, width - 110, height - 110], fill=(180, 40, 40))
+    draw.text((width // 2 - 250, 120), 'CERTIFICATE OF COMPLETION', fill=(60, 40, 10),
+              font=app.get_font('Arial', 40, bold=True))
+    img.save(path)
+
+def bench_zip(args):
+    """Time zip archiving of rendered certificates under each compression policy."""
+    random.seed(0)
+    boxes = [
+        {'column': 'Name', 'x': 300, 'y': 450, 'width': 1000, 'height': 120, 'fontSize': 72, 'align': 'center'},
+        {'column': 'Course', 'x': 300, 'y': 650, 'width': 1000, 'height': 200, 'fontSize': 32, 'align': 'center'}
+    ]
+    rows = [{'Name': ' '.join(random.choice(WORDS).title() for _ in range(3)),
+             'Course': ' '.join(random.choice(WORDS) for _ in range(25))}
+            for _ in range(args.rows)]
+
+    with tempfile.TemporaryDirectory() as tmp:
+        template_path = args.template
+        if template_path is None:
+            template_path = os.path.join(tmp, 'certificate.png')
+            make_certificate_template(template_path)
+        start = time.perf_counter()
+        images = [(f'image_{idx+1}.png', png_bytes)
+                  for idx, png_bytes in app.render_rows(template_path, boxes, rows)]
+        print(f"rendered {len(images)} certificates in {time.perf_counter() - start:.1f}s, "
+              f"{sum(len(data) for _, data in images) / 2**20:.1f} MiB of PNG")
+
+    print(f"{'policy':>9} {'wall ms':>9} {'cpu ms':>9} {'size MiB':>9}")
+    for policy in ('deflated', 'stored', 'auto'):
+        best = None
+        for _ in range(3):
+            buffer = io.BytesIO()
+            wall, cpu = time.perf_counter(), time.process_time()
+            with zipfile.ZipFile(buffer, 'w') as zipf:
+                for name, data in images:
+                    zipf.writestr(name, data, compress_type=app.archive_compression(name, policy))
+            wall, cpu = time.perf_counter() - wall, time.process_time() - cpu
+            if best is None or wall < best[0]:
+                best = (wall, cpu, buffer.tell())
+        wall, cpu, size = best
+        print(f"{policy:>9} {wall * 1000:>9.1f} {cpu * 1000:>9.1f} {size / 2**20:>9.2f}")
+
+def make_registration_csv(path, rows, columns):
+    """Write a synthetic registration export with ID, ZIP code, amount and free-text columns."""
+    random.seed(0)
+    header = ['ID', 'Name', 'Email', 'ZIP', 'Amount', 'Registered']
+    header += [f'Note {n}' for n in range(1, max(columns - len(header), 0) + 1)]
+    with open(path, 'w', encoding='utf-8', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(header[:columns])
+        for idx in range(rows):
+            name = ' '.join(random.choice(WORDS).title() for _ in range(2))
+            row = [f'{idx:07d}', name, f'{name.replace(" ", ".").lower()}@example.com',
+                   f'{random.randrange(100000):05d}', f'{random.random() * 500:.2f}',
+                   f'2024-{random.randrange(1, 13):02d}-{random.randrange(1, 29):02d}']
+            row += [' '.join(random.choice(WORDS) for _ in range(random.randrange(0, 12)))
+                    for _ in range(len(header) - len(row))]
+            writer.writerow(row[:columns])
+
+def bench_csv(args):
+    """Compare the CSV engines' parse time and peak Python memory on synthetic exports."""
+    engines = [engine for engine in app.CSV_ENGINES if engine != 'pyarrow' or app.pa_csv is not None]
+    if len(engines) < len(app.CSV_ENGINES):
+        print("pyarrow is not installed; skipping the pyarrow engine")
+
+    def parse(path, engine):
+        return sum(len(df) for df in app.iter_csv_frames(path, args.chunk_rows, engine))
+
+    print(f"{'rows':>8} {'MiB':>6} {'engine':>8} {'wall ms':>9} {'peak MiB':>9}")
+    with tempfile.TemporaryDirectory() as tmp:
+        for rows in args.rows:
+            path = os.path.join(tmp, f'registrations_{rows}.csv')
+            make_registration_csv(path, rows, args.columns)
+            size = os.path.getsize(path)
+            for engine in engines:
+                # Time without tracing, then measure memory in a separate pass
+                start = time.perf_counter()
+                parsed = parse(path, engine)
+                elapsed = time.perf_counter() - start
+                assert parsed == rows, (engine, parsed)
+                tracemalloc.start()
+                parse(path, engine)
+                _, peak = tracemalloc.get_traced_memory()
+                tracemalloc.stop()
+                print(f"{rows:>8} {size / 2**20:>6.1f} {engine:>8} {elapsed * 1000:>9.1f} {peak / 2**20:>9.1f}")
+    print("peak memory counts Python allocations only, not the parsers' internal C/Arrow buffers")
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    subparsers = parser.add_subparsers(dest='benchmark', required=True)
+
+    wrap_parser = subparsers.add_parser('wrap', help=bench_wrap.__doc__)
+    wrap_parser.add_argument('--cells', type=int, default=200, help='cells per configuration')
+    wrap_parser.set_defaults(func=bench_wrap)
+
+    zip_parser = subparsers.add_parser('zip', help=bench_zip.__doc__)
+    zip_parser.add_argument('--rows', type=int, default=300, help='certificates to render')
+    zip_parser.add_argument('--template', help='template image (default: a generated certificate)')
+    zip_parser.set_defaults(func=bench_zip)
+
+    csv_parser = subparsers.add_parser('csv', help=bench_csv.__doc__)
+    csv_parser.add_argument('--rows', type=int, nargs='+', default=[100000], help='data rows per file')
+    csv_parser.add_argument('--columns', type=int, default=12, help='columns per row')
+    csv_parser.add_argument('--chunk-rows', type=int, default=10000, help='rows per parsed chunk')
+    csv_parser.set_defaults(func=bench_csv)
+
+    args = parser.parse_args()
+    args.func(args)
+
+if __name__ == '__main__':
+    main()
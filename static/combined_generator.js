@@ -201,6 +201,99 @@ document.addEventListener('DOMContentLoaded', function() {
         }
     }
 
+    // Size the preview is shown at, in device pixels, so the server can
+    // render a low-resolution image instead of the full template
+    function previewDisplaySize() {
+        if (!window.templateDimensions) {
+            return {};
+        }
+        const ratio = window.devicePixelRatio || 1;
+        return {
+            display_width: Math.ceil(window.templateDimensions.width * ratio),
+            display_height: Math.ceil(window.templateDimensions.height * ratio)
+        };
+    }
+
+    // URL of a record's preview in the current preview session
+    function sessionPreviewUrl(index) {
+        const params = new URLSearchParams(previewDisplaySize());
+        return `/sessions/${window.previewSessionId}/preview/${index}?${params}`;
+    }
+
+    // Point an <img> at a URL and resolve once it has loaded
+    function loadImage(img, src) {
+        return new Promise((resolve, reject) => {
+            if (img.getAttribute('src') === src && img.complete) {
+                resolve(img);
+                return;
+            }
+            img.onload = () => resolve(img);
+            img.onerror = () => reject(new Error('Could not load preview image'));
+            img.src = src;
+        });
+    }
+
+    // Random id used to follow a request's progress via /jobs/<id>/events
+    function makeJobId() {
+        return Array.from(crypto.getRandomValues(new Uint8Array(12)), b => b.toString(16).padStart(2, '0')).join('');
+    }
+
+    // Follow a job's progress over Server-Sent Events. Returns the job's
+    // result as a promise plus a close() function to stop listening early.
+    // onProgress, if given, receives each progress update.
+    function followJob(jobId, containerId, scale = 1, onProgress = null) {
+        const source = new EventSource(`/jobs/${jobId}/events`);
+        const done = new Promise((resolve, reject) => {
+            source.addEventListener('progress', event => {
+                const jobData = JSON.parse(event.data);
+                updateProgress(jobData.progress.percent * scale, containerId);
+                if (onProgress) {
+                    onProgress(jobData.progress);
+                }
+            });
+            source.addEventListener('complete', event => {
+                source.close();
+                resolve(JSON.parse(event.data).result);
+            });
+            source.addEventListener('failed', event => {
+                source.close();
+                reject(new Error(JSON.parse(event.data).error || 'Job failed'));
+            });
+            source.onerror = () => {
+                // The server closes the stream after the final event, so this
+                // only fires if the connection drops before the job finished
+                source.close();
+                reject(new Error('Lost track of the rendering job'));
+            };
+        });
+        return { done, close: () => source.close() };
+    }
+
+    // POST a JSON payload as a form field into a hidden iframe, so the
+    // response is handled as a file download without leaving the page
+    function submitDownloadForm(action, payload) {
+        let frame = document.getElementById('downloadFrame');
+        if (!frame) {
+            frame = document.createElement('iframe');
+            frame.id = 'downloadFrame';
+            frame.name = 'downloadFrame';
+            frame.style.display = 'none';
+            document.body.appendChild(frame);
+        }
+        const form = document.createElement('form');
+        form.method = 'POST';
+        form.action = action;
+        form.target = frame.name;
+        const field = document.createElement('input');
+        field.type = 'hidden';
+        field.name = 'payload';
+        field.value = JSON.stringify(payload);
+        form.appendChild(field);
+        document.body.appendChild(form);
+        form.submit();
+        form.remove();
+    }
+
     function hideProgressBar(containerId = 'combinedProgressContainer') {
         const container = document.getElementById(containerId);
         if (container) {
@@ -375,6 +468,10 @@ document.addEventListener('DOMContentLoaded', function() {
         
         const formData = new FormData();
         formData.append('csv', file);
+        const sheetSelect = document.getElementById('combinedCsvSheet');
+        if (sheetSelect.value) {
+            formData.append('sheet', sheetSelect.value);
+        }
 
         try {
             const response = await fetch('/upload_csv', {
@@ -389,16 +486,66 @@ document.addEventListener('DOMContentLoaded', function() {
             
             const data = await response.json();
             csvData = data.preview;
-            window.fullCsvData = data.all_data;
-            updateCsvPreview(data.columns, data.preview);
+            // The rows stay on the server; merges refer to them by dataset id
+            window.datasetId = data.dataset_id;
+            window.datasetRows = data.total_rows;
+            window.csvPageOffset = 0;
+            updateCsvPreview(data.columns, data.preview.slice(0, CSV_PAGE_SIZE));
+            updateCsvPager();
             updateColumnSelects(data.columns);
+            updateSheetSelect(data.sheets, data.sheet);
             
-            displayStatus('CSV data uploaded successfully');
+            if (data.complete) {
+                displayStatus('CSV data uploaded successfully');
+            } else {
+                // Large files are still being parsed; previews and downloads
+                // can start now and the row count catches up as it goes
+                displayStatus('CSV uploaded, reading rows...');
+                followDatasetIngest(data.dataset_id, data.ingest_job_id);
+            }
         } catch (error) {
             displayStatus('Error uploading file: ' + error.message, true);
         }
     });
 
+    // Workbooks with several worksheets: picking another one uploads the file again for that sheet.
+    // The server deletes each upload once it is parsed, so switching sheets costs a full re-upload.
+    function updateSheetSelect(sheets, selected) {
+        const select = document.getElementById('combinedCsvSheet');
+        select.replaceChildren(...(sheets || []).map(name => new Option(name, name)));
+        select.value = selected || '';
+        select.classList.toggle('d-none', !sheets || sheets.length < 2);
+    }
+
+    document.getElementById('combinedCsvSheet').addEventListener('change', () => {
+        document.getElementById('combinedCsvForm').requestSubmit();
+    });
+
+    document.getElementById('combinedCsv').addEventListener('change', () => {
+        updateSheetSelect(null);
+    });
+
+    function followDatasetIngest(datasetId, jobId) {
+        const setRows = rows => {
+            if (window.datasetId !== datasetId) {
+                return;
+            }
+            window.datasetRows = rows;
+            updateCsvPager();
+            if (window.previewDatasetId === datasetId) {
+                window.totalRecords = rows;
+                document.getElementById('totalImagesCount').textContent = rows;
+                document.getElementById('currentImageInput').max = rows;
+            }
+        };
+        followJob(jobId, null, 1, progress => setRows(progress.rows_done)).done
+            .then(result => {
+                setRows(result.total_rows);
+                displayStatus(`CSV data uploaded successfully (${window.datasetRows} rows)`);
+            })
+            .catch(error => displayStatus('Error reading CSV: ' + error.message, true));
+    }
+
     function updateCsvPreview(columns, data) {
         const headers = document.getElementById('combinedCsvHeaders');
         const tbody = document.getElementById('combinedCsvData');
@@ -406,10 +553,50 @@ document.addEventListener('DOMContentLoaded', function() {
         headers.innerHTML = `<tr>${columns.map(col => `<th>${col}</th>`).join('')}</tr>`;
         
         tbody.innerHTML = data.map(row => 
-            `<tr>${columns.map(col => `<td>${row[col]}</td>`).join('')}</tr>`
+            `<tr>${columns.map(col => `<td>${row[col] ?? ''}</td>`).join('')}</tr>`
         ).join('');
     }
 
+    // Page through the uploaded rows; only one page is ever held in the browser
+    const CSV_PAGE_SIZE = 20;
+
+    function updateCsvPager() {
+        const pager = document.getElementById('combinedCsvPager');
+        const total = window.datasetRows || 0;
+        const offset = window.csvPageOffset || 0;
+        pager.classList.toggle('d-none', total <= CSV_PAGE_SIZE);
+        document.getElementById('csvPageInfo').textContent =
+            `Rows ${total ? offset + 1 : 0}-${Math.min(offset + CSV_PAGE_SIZE, total)} of ${total}`;
+        document.getElementById('csvPrevPageBtn').disabled = offset === 0;
+        document.getElementById('csvNextPageBtn').disabled = offset + CSV_PAGE_SIZE >= total;
+    }
+
+    async function loadCsvPage(offset) {
+        if (!window.datasetId) {
+            return;
+        }
+        try {
+            const response = await fetch(`/datasets/${window.datasetId}/rows?offset=${offset}&limit=${CSV_PAGE_SIZE}`);
+            const data = await response.json();
+            if (!response.ok) {
+                throw new Error(data.error || 'Could not load rows');
+            }
+            window.csvPageOffset = offset;
+            updateCsvPreview(data.columns, data.rows);
+            updateCsvPager();
+        } catch (error) {
+            displayStatus('Error loading rows: ' + error.message, true);
+        }
+    }
+
+    document.getElementById('csvPrevPageBtn').addEventListener('click', () => {
+        loadCsvPage(Math.max(0, window.csvPageOffset - CSV_PAGE_SIZE));
+    });
+
+    document.getElementById('csvNextPageBtn').addEventListener('click', () => {
+        loadCsvPage(window.csvPageOffset + CSV_PAGE_SIZE);
+    });
+
     function updateColumnSelects(columns) {
         // Update both text and image column selects
         const textColumnSelect = document.getElementById('combinedTextColumnSelect');
@@ -932,55 +1119,32 @@ document.addEventListener('DOMContentLoaded', function() {
                 return config;
             });
 
-            const formattedCsvData = window.fullCsvData || csvData;
-            const totalRecords = formattedCsvData.length;
-
-            // For faster preview generation, only request the first row's preview initially
-            const firstRowData = [formattedCsvData[0]];
-
-            // Function to poll progress
-            const checkProgress = async () => {
-                try {
-                    const progressResponse = await fetch('/preview_progress');
-                    if (progressResponse.ok) {
-                        const progressData = await progressResponse.json();
-                        updateProgress(progressData.percent, 'combinedProgressContainer');
-                        
-                        if (progressData.percent < 100) {
-                            setTimeout(checkProgress, 500); // Poll every 500ms
-                        }
-                    }
-                } catch (error) {
-                    console.error('Error checking progress:', error);
-                }
-            };
-
-            // Start progress polling
-            setTimeout(checkProgress, 500);
+            const totalRecords = window.datasetRows;
 
-            const response = await fetch('/preview_combined_images', {
+            // Store the rows and layout once; each record's preview is then a
+            // plain GET that the browser can revalidate with its ETag
+            const response = await fetch('/sessions', {
                 method: 'POST',
                 headers: {
                     'Content-Type': 'application/json'
                 },
                 body: JSON.stringify({
                     template: currentTemplate,
-                    csv_data: firstRowData,
+                    dataset_id: window.datasetId,
                     text_boxes: boxConfigs
                 })
             });
 
             const data = await response.json();
             if (response.ok) {
-                // Store all CSV data for on-demand preview generation
-                window.allCsvData = formattedCsvData;
+                // Keep the layout and dataset for downloads
+                window.previewDatasetId = window.datasetId;
                 window.previewBoxConfigs = boxConfigs;
                 window.currentTemplateFile = currentTemplate;
 
-                // Store first preview URL and show it
-                window.previewUrls = data.preview_urls;
+                window.previewSessionId = data.id;
                 window.currentPreviewIndex = 0;
-                window.totalRecords = formattedCsvData.length;
+                window.totalRecords = totalRecords;
 
                 // Hide the carousel and show the single preview container
                 const carousel = document.getElementById('combinedPreviewCarousel');
@@ -991,7 +1155,7 @@ document.addEventListener('DOMContentLoaded', function() {
 
                 // Update the preview image
                 const singlePreview = document.getElementById('combinedSinglePreview');
-                singlePreview.src = data.preview_urls[0];
+                await loadImage(singlePreview, sessionPreviewUrl(0));
 
                 // Set preview image dimensions to match template
                 if (window.templateDimensions) {
@@ -1008,15 +1172,15 @@ document.addEventListener('DOMContentLoaded', function() {
                 }
 
                 // Update the counter
-                document.getElementById('totalImagesCount').textContent = formattedCsvData.length;
+                document.getElementById('totalImagesCount').textContent = totalRecords;
                 document.getElementById('currentImageInput').value = 1;
-                document.getElementById('currentImageInput').max = formattedCsvData.length;
+                document.getElementById('currentImageInput').max = totalRecords;
 
                 // Enable the download button
                 const downloadBtn = document.getElementById('combinedDownloadBtn');
                 downloadBtn.disabled = false;
 
-                displayStatus(`Preview generated. Total records: ${formattedCsvData.length}`);
+                displayStatus(`Preview generated. Total records: ${totalRecords}`);
             } else {
                 throw new Error(data.error);
             }
@@ -1058,10 +1222,13 @@ document.addEventListener('DOMContentLoaded', function() {
     }
     
     async function loadPreviewForRecord(index) {
-        // If we already have this preview, just show it
-        if (window.previewUrls[index]) {
+        const statusDiv = document.getElementById('combinedStatus');
+        statusDiv.textContent = `Loading preview for record ${index + 1}...`;
+        
+        try {
+            // Rows the browser has already seen come back as 304s
             const singlePreview = document.getElementById('combinedSinglePreview');
-            singlePreview.src = window.previewUrls[index];
+            await loadImage(singlePreview, sessionPreviewUrl(index));
             
             // Set preview image dimensions to match template
             if (window.templateDimensions) {
@@ -1072,53 +1239,8 @@ document.addEventListener('DOMContentLoaded', function() {
             
             window.currentPreviewIndex = index;
             document.getElementById('currentImageInput').value = index + 1;
-            return;
-        }
-        
-        // Otherwise, generate it
-        const statusDiv = document.getElementById('combinedStatus');
-        const originalStatus = statusDiv.textContent;
-        statusDiv.textContent = `Generating preview for record ${index + 1}...`;
-        
-        try {
-            // Generate preview for the requested record
-            const recordData = [window.allCsvData[index]];
-            
-            const response = await fetch('/preview_combined_images', {
-                method: 'POST',
-                headers: {
-                    'Content-Type': 'application/json'
-                },
-                body: JSON.stringify({
-                    template: window.currentTemplateFile,
-                    csv_data: recordData,
-                    text_boxes: window.previewBoxConfigs
-                })
-            });
             
-            const data = await response.json();
-            if (response.ok) {
-                // Store the preview URL
-                window.previewUrls[index] = data.preview_urls[0];
-                
-                // Update the preview image
-                const singlePreview = document.getElementById('combinedSinglePreview');
-                singlePreview.src = data.preview_urls[0];
-                
-                // Set preview image dimensions to match template
-                if (window.templateDimensions) {
-                    singlePreview.style.width = window.templateDimensions.width + 'px';
-                    singlePreview.style.height = window.templateDimensions.height + 'px';
-                    singlePreview.style.objectFit = 'contain';
-                }
-                
-                window.currentPreviewIndex = index;
-                document.getElementById('currentImageInput').value = index + 1;
-                
-                statusDiv.textContent = `Showing record ${index + 1} of ${window.totalRecords}`;
-            } else {
-                throw new Error(data.error);
-            }
+            statusDiv.textContent = `Showing record ${index + 1} of ${window.totalRecords}`;
         } catch (error) {
             console.error('Error generating preview:', error);
             statusDiv.textContent = 'Error generating preview: ' + error.message;
@@ -1129,7 +1251,7 @@ document.addEventListener('DOMContentLoaded', function() {
 
     // Download Images
     document.getElementById('combinedDownloadBtn').addEventListener('click', async () => {
-        if (!window.currentTemplateFile || !window.allCsvData || !window.previewBoxConfigs) {
+        if (!window.currentTemplateFile || !window.previewDatasetId || !window.previewBoxConfigs) {
             displayStatus('No preview data available to download', true);
             return;
         }
@@ -1142,86 +1264,24 @@ document.addEventListener('DOMContentLoaded', function() {
             displayStatus('Generating all images for download. This may take a moment...');
             showProgressBar('combinedDownloadProgress', true); // Start with indeterminate progress
 
-            // Function to poll download progress
-            const checkDownloadProgress = async () => {
-                try {
-                    const progressResponse = await fetch('/download_progress');
-                    if (progressResponse.ok) {
-                        const progressData = await progressResponse.json();
-                        
-                        // Scale down the progress - max 90% from server
-                        // This leaves room for the final step (initiating download)
-                        if (progressData.percent < 100) {
-                            const scaledPercent = progressData.percent * 0.9; // Scale to max 90%
-                            updateProgress(scaledPercent, 'combinedDownloadProgress');
-                            setTimeout(checkDownloadProgress, 500); // Poll every 500ms
-                        } else {
-                            // Still don't show 100% - wait for actual download to start
-                            updateProgress(95, 'combinedDownloadProgress');
-                        }
-                    }
-                } catch (error) {
-                    console.error('Error checking download progress:', error);
-                }
-            };
-
-            // Start progress polling
-            setTimeout(checkDownloadProgress, 500);
-
-            // Generate all previews
-            const response = await fetch('/preview_combined_images', {
-                method: 'POST',
-                headers: {
-                    'Content-Type': 'application/json'
-                },
-                body: JSON.stringify({
-                    template: window.currentTemplateFile,
-                    csv_data: window.allCsvData,
-                    text_boxes: window.previewBoxConfigs
-                })
-            });
-
-            if (!response.ok) {
-                const errorData = await response.json();
-                throw new Error(errorData.error || 'Failed to generate preview images');
-            }
-
-            const data = await response.json();
-            
-            displayStatus(`Generated ${data.preview_urls.length} images. Preparing download...`);
-            updateProgress(96, 'combinedDownloadProgress');
-            
-            // Prepare images for individual download
-            const prepareResponse = await fetch('/download_individual', {
-                method: 'POST',
-                headers: {
-                    'Content-Type': 'application/json'
-                },
-                body: JSON.stringify({
-                    preview_urls: data.preview_urls
-                })
+            // Stream the zip straight from the renderer. A form post into a hidden
+            // iframe lets the browser save the archive to disk as it arrives.
+            const downloadJobId = makeJobId();
+            const downloadJob = followJob(downloadJobId, 'combinedDownloadProgress');
+            submitDownloadForm('/stream_batch', {
+                template: window.currentTemplateFile,
+                dataset_id: window.previewDatasetId,
+                text_boxes: window.previewBoxConfigs,
+                format: document.getElementById('combinedOutputFormat').value,
+                job_id: downloadJobId
             });
 
-            if (!prepareResponse.ok) {
-                const errorData = await prepareResponse.json();
-                throw new Error(errorData.error || 'Failed to prepare images for download');
-            }
-
-            const downloadData = await prepareResponse.json();
-            updateProgress(98, 'combinedDownloadProgress');
-            
-            // Short delay to show almost complete
-            await new Promise(resolve => setTimeout(resolve, 500));
-            
-            // Only set to 100% right before initiating download
+            const downloadData = await downloadJob.done;
             updateProgress(100, 'combinedDownloadProgress');
             
-            // Initiate direct download of the prepared zip file
-            // Use both timestamp and unique_id in the URL
-            const downloadUrl = `/download_batch/${downloadData.timestamp}/${downloadData.unique_id}`;
-            window.location.href = downloadUrl;
-            
-            displayStatus(`Download initiated for ${downloadData.file_count} images.`);
+            displayStatus(downloadData.format === 'pdf'
+                ? `Downloaded a PDF with ${downloadData.file_count} pages.`
+                : `Downloaded ${downloadData.file_count} images.`);
 
             // Re-enable the button after a short delay to allow download to start
             setTimeout(() => {
@@ -0,0 +1,57 @@
+import pandas as pd
+import pytest
+
+import app
+
+# Short lines, a line with too many fields, a quoted newline, blank lines,
+# a BOM and blank/duplicate header cells
+RAGGED_CSV = (
+    '﻿Name,ZIP,City,,Name\n'
+    'Alice,01234,Boston,x,A2\n'
+    'Bob,02345\n'
+    '\n'
+    '"Multi\nline",1,2,3,4\n'
+    'Too,many,fields,in,this,line\n'
+    'NA,null,,N/A,7\n'
+    'Carol\n'
+    'Dave,00001,Denver,y,D2\n'
+)
+
+def engines():
+    params = []
+    for engine in app.CSV_ENGINES:
+        marks = []
+        if engine == 'pyarrow' and app.pa_csv is None:
+            marks.append(pytest.mark.skip(reason='pyarrow is not installed'))
+        params.append(pytest.param(engine, marks=marks))
+    return params
+
+def parse(path, engine, chunk_rows):
+    frames = list(app.iter_csv_frames(str(path), chunk_rows, engine))
+    return [len(df) for df in frames], app.frame_records(pd.concat(frames, ignore_index=True))
+
+@pytest.fixture
+def ragged_csv(tmp_path):
+    path = tmp_path / 'ragged.csv'
+    path.write_text(RAGGED_CSV, encoding='utf-8')
+    return path
+
+@pytest.mark.parametrize('engine', engines())
+@pytest.mark.parametrize('chunk_rows', [2, 10000])
+def test_engines_agree_on_ragged_csv(ragged_csv, engine, chunk_rows):
+    assert parse(ragged_csv, engine, chunk_rows) == parse(ragged_csv, 'c', chunk_rows)
+
+@pytest.mark.parametrize('engine', engines())
+def test_short_rows_are_padded(ragged_csv, engine):
+    _, records = parse(ragged_csv, engine, 10000)
+    assert [record['Name'] for record in records] == ['Alice', 'Bob', 'Multi\nline', 'NA', 'Carol', 'Dave']
+    assert records[1] == {'Name': 'Bob', 'ZIP': '02345', 'City': None, 'Unnamed: 3': None, 'Name.1': None}
+    assert records[3]['ZIP'] == 'null'
+    assert records[5]['ZIP'] == '00001'
+
+@pytest.mark.parametrize('engine', engines())
+def test_header_only_csv_keeps_columns(tmp_path, engine):
+    path = tmp_path / 'header.csv'
+    path.write_text('a,b\n', encoding='utf-8')
+    frames = list(app.iter_csv_frames(str(path), 10, engine))
+    assert [(len(df), list(df.columns)) for df in frames] == [(0, ['a', 'b'])]
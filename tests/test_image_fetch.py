@@ -0,0 +1,158 @@
+import io
+import socket
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+from PIL import Image, ImageDraw
+
+import app
+
+def png_bytes(color='blue'):
+    buf = io.BytesIO()
+    Image.new('RGB', (8, 8), color).save(buf, format='PNG')
+    return buf.getvalue()
+
+PNG = png_bytes()
+
+class ImageHandler(BaseHTTPRequestHandler):
+    """Serves PNG for /img/..., 404 for /missing/... and an ETag for /etag."""
+
+    def do_GET(self):
+        server = self.server
+        with server.lock:
+            server.hits[self.path] = server.hits.get(self.path, 0) + 1
+            server.active += 1
+            server.max_active = max(server.max_active, server.active)
+        try:
+            time.sleep(server.delay)
+            if self.path.startswith('/missing'):
+                self.send_response(404)
+                self.end_headers()
+            elif self.path == '/etag' and self.headers.get('If-None-Match') == '"v1"':
+                server.conditional += 1
+                self.send_response(304)
+                self.end_headers()
+            else:
+                self.send_response(200)
+                self.send_header('Content-Type', 'image/png')
+                self.send_header('Content-Length', str(len(PNG)))
+                if self.path == '/etag':
+                    self.send_header('ETag', '"v1"')
+                self.end_headers()
+                self.wfile.write(PNG)
+        finally:
+            with server.lock:
+                server.active -= 1
+
+    def log_message(self, *args):
+        pass
+
+@pytest.fixture
+def server():
+    httpd = ThreadingHTTPServer(('127.0.0.1', 0), ImageHandler)
+    httpd.lock = threading.Lock()
+    httpd.hits = {}
+    httpd.active = 0
+    httpd.max_active = 0
+    httpd.conditional = 0
+    httpd.delay = 0
+    httpd.base = f'http://127.0.0.1:{httpd.server_address[1]}'
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    yield httpd
+    httpd.shutdown()
+    httpd.server_close()
+
+@pytest.fixture(autouse=True)
+def image_cache(tmp_path, monkeypatch):
+    # Each test gets its own cache directory; tests that want caching turn it on
+    monkeypatch.setitem(app.app.config, 'IMAGE_CACHE_DIR', str(tmp_path / 'image_cache'))
+    monkeypatch.setitem(app.app.config, 'IMAGE_CACHE_MAX_BYTES', 0)
+    monkeypatch.setitem(app._image_cache, 'pid', None)
+    monkeypatch.setitem(app._image_cache, 'cache', None)
+
+def closed_port_url():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        port = sock.getsockname()[1]
+    return f'http://127.0.0.1:{port}/img/gone.png'
+
+def test_prefetcher_respects_per_host_limit(server):
+    server.delay = 0.2
+    urls = [f'{server.base}/img/{i}.png' for i in range(6)]
+    prefetcher = app.ImagePrefetcher(max_workers=8, per_host=2)
+    try:
+        results = prefetcher.fetch_many(urls)
+    finally:
+        prefetcher.close()
+    assert all(results[url] == PNG for url in urls)
+    assert server.max_active == 2
+
+def test_prefetcher_fetches_repeated_urls_once(server):
+    url = f'{server.base}/img/logo.png'
+    prefetcher = app.ImagePrefetcher(max_workers=4, per_host=4)
+    try:
+        first = prefetcher.fetch_many([url, url, url])
+        second = prefetcher.fetch_many([url])
+    finally:
+        prefetcher.close()
+    assert first == {url: PNG}
+    assert second == {url: PNG}
+    assert server.hits == {'/img/logo.png': 1}
+
+def test_prefetcher_reports_failures(server):
+    missing = f'{server.base}/missing/logo.png'
+    gone = closed_port_url()
+    prefetcher = app.ImagePrefetcher(max_workers=2, per_host=2)
+    try:
+        results = prefetcher.fetch_many([missing, gone])
+    finally:
+        prefetcher.close()
+    assert results[missing] is None
+    assert isinstance(results[gone], app.ImageFetchError)
+
+def test_fetch_image_bytes_returns_none_for_non_200(server):
+    assert app.fetch_image_bytes(f'{server.base}/missing/logo.png') is None
+    assert app.fetch_image_bytes(f'{server.base}/img/logo.png') == PNG
+
+def test_draw_image_box_handles_failed_fetches():
+    box = {'x': 10, 'y': 10, 'width': 60, 'height': 40, 'isImage': True}
+    img = Image.new('RGB', (100, 100), 'white')
+    draw = ImageDraw.Draw(img)
+
+    # A non-200 response leaves the box empty
+    assert app.draw_image_box(draw, box, 'missing', 100, 100, images={'missing': None}) is None
+    assert img.getcolors() == [(100 * 100, (255, 255, 255))]
+
+    # A fetch error draws the red placeholder
+    error = app.ImageFetchError('connection refused')
+    assert app.draw_image_box(draw, box, 'gone', 100, 100, images={'gone': error}) is None
+    assert img.getpixel((10, 30)) == (255, 0, 0)
+
+def test_disk_cache_revalidates_with_etag(server, monkeypatch):
+    monkeypatch.setitem(app.app.config, 'IMAGE_CACHE_MAX_BYTES', 1024 * 1024)
+    monkeypatch.setitem(app.app.config, 'IMAGE_CACHE_TTL', 0)
+    url = f'{server.base}/etag'
+
+    assert app.fetch_image_bytes(url) == PNG
+    assert server.conditional == 0
+
+    # With ttl=0 the record is stale at once, so the next fetch is a conditional GET
+    assert app.fetch_image_bytes(url) == PNG
+    assert server.conditional == 1
+    assert server.hits == {'/etag': 2}
+
+    record, data = app.get_image_cache().lookup(url)
+    assert record['etag'] == '"v1"'
+    assert data == PNG
+
+def test_disk_cache_serves_fresh_entries_without_a_request(server, monkeypatch):
+    monkeypatch.setitem(app.app.config, 'IMAGE_CACHE_MAX_BYTES', 1024 * 1024)
+    monkeypatch.setitem(app.app.config, 'IMAGE_CACHE_TTL', 3600)
+    url = f'{server.base}/etag'
+
+    assert app.fetch_image_bytes(url) == PNG
+    assert app.fetch_image_bytes(url) == PNG
+    assert server.hits == {'/etag': 1}
@@ -0,0 +1,166 @@
+import os
+import subprocess
+import sys
+import time
+from contextlib import closing
+
+import pytest
+from PIL import Image
+
+import app
+
+BOXES = [{'column': 'Name', 'x': 10, 'y': 10, 'width': 150, 'height': 30, 'fontSize': 14}]
+ROWS = [{'Name': 'Alice'}, {'Name': 'Bob'}, {'Name': 'Carol'}]
+
+@pytest.fixture(autouse=True)
+def job_store(tmp_path, monkeypatch):
+    # Batch files and templates live under the working directory
+    monkeypatch.chdir(tmp_path)
+    os.makedirs(os.path.join('static', 'uploads'))
+    os.makedirs(os.path.join('static', 'downloads'))
+    Image.new('RGB', (200, 60), 'white').save(os.path.join('static', 'uploads', 'template.png'))
+    monkeypatch.setitem(app.app.config, 'JOBS_DB', str(tmp_path / 'jobs.sqlite3'))
+    monkeypatch.setitem(app.app.config, 'RENDER_CHUNK_SIZE', 100)
+
+@pytest.fixture
+def client():
+    return app.app.test_client()
+
+def expire(now=None):
+    with closing(app.jobs_db()) as conn, conn:
+        app.expire_jobs(conn, now)
+
+def wait_for_job(client, job_id, timeout=30):
+    deadline = time.time() + timeout
+    while True:
+        job = client.get(f'/jobs/{job_id}').get_json()
+        if job['state'] in (app.JOB_COMPLETE, app.JOB_FAILED) or time.time() > deadline:
+            return job
+        time.sleep(0.05)
+
+def dead_pid():
+    proc = subprocess.Popen([sys.executable, '-c', ''])
+    proc.wait()
+    return proc.pid
+
+def test_submitted_job_runs_to_completion(client):
+    response = client.post('/jobs', json={'template': 'template.png', 'text_boxes': BOXES, 'csv_data': ROWS})
+    assert response.status_code == 202
+    summary = response.get_json()
+    assert summary['kind'] == 'merge'
+    assert summary['state'] in (app.JOB_QUEUED, app.JOB_RUNNING, app.JOB_COMPLETE)
+    assert 'params' not in summary
+
+    job = wait_for_job(client, summary['id'])
+    assert job['state'] == app.JOB_COMPLETE, job['error']
+    assert job['progress']['rows_done'] == 3
+    assert job['progress']['rows_total'] == 3
+    assert job['progress']['percent'] == 100
+    assert job['progress']['bytes_written'] > 0
+    assert job['result']['file_count'] == 3
+    assert os.path.exists(os.path.join('static', 'downloads', job['result']['filename']))
+
+def test_submit_rejects_bad_requests(client):
+    assert client.post('/jobs', json={'template': 'template.png', 'text_boxes': BOXES}).status_code == 400
+    missing = client.post('/jobs', json={'template': 'missing.png', 'text_boxes': BOXES, 'csv_data': ROWS})
+    assert missing.status_code == 404
+
+def test_unknown_job_is_404(client):
+    response = client.get('/jobs/doesnotexist')
+    assert response.status_code == 404
+    assert response.get_json() == {'error': 'Job not found'}
+
+def test_job_is_claimed_once():
+    job_id = app.create_job('merge', {})
+    assert app.get_job(job_id)['state'] == app.JOB_QUEUED
+    assert app.claim_job(job_id)
+    assert not app.claim_job(job_id)
+    job = app.get_job(job_id)
+    assert job['state'] == app.JOB_RUNNING
+    assert job['started_at'] is not None
+
+def test_progress_is_written_to_the_job(client):
+    job_id = app.create_job('merge', {}, state=app.JOB_RUNNING, rows_total=4)
+    progress = app.JobProgress(job_id, 4, interval=0)
+    progress.update(status='rendering images')
+    progress.advance(nbytes=100)
+    progress.advance(nbytes=50)
+
+    job = client.get(f'/jobs/{job_id}').get_json()
+    assert job['state'] == app.JOB_RUNNING
+    assert job['progress']['status'] == 'rendering images'
+    assert job['progress']['rows_done'] == 2
+    assert job['progress']['bytes_written'] == 150
+    assert job['progress']['percent'] == 50
+
+    assert progress.complete({'file_count': 4})
+    job = client.get(f'/jobs/{job_id}').get_json()
+    assert job['state'] == app.JOB_COMPLETE
+    assert job['result'] == {'file_count': 4}
+
+def test_stale_running_jobs_are_failed(monkeypatch):
+    monkeypatch.setitem(app.app.config, 'JOB_STALE_AFTER', 0.1)
+    job_id = app.create_job('merge', {})
+    app.claim_job(job_id)
+    expire()
+    assert app.get_job(job_id)['state'] == app.JOB_RUNNING
+
+    expire(time.time() + 1)
+    job = app.get_job(job_id)
+    assert job['state'] == app.JOB_FAILED
+    assert 'interrupted' in job['error']
+
+def test_queued_jobs_wait_while_their_owner_is_alive(monkeypatch):
+    monkeypatch.setitem(app.app.config, 'JOB_STALE_AFTER', 0.1)
+    waiting = app.create_job('merge', {})
+    orphaned = app.create_job('merge', {})
+    app.update_job(orphaned, owner_pid=dead_pid())
+    rebooted = app.create_job('merge', {})
+    app.update_job(rebooted, owner_boot='an earlier boot')
+
+    expire(time.time() + 60)
+    assert app.get_job(waiting)['state'] == app.JOB_QUEUED
+    assert app.get_job(orphaned)['state'] == app.JOB_FAILED
+    assert app.get_job(rebooted)['state'] == app.JOB_FAILED
+
+def test_expired_job_stops_and_keeps_its_failure(monkeypatch):
+    monkeypatch.setitem(app.app.config, 'JOB_STALE_AFTER', 0.1)
+    job_id = app.create_job('merge', {}, state=app.JOB_RUNNING)
+    progress = app.JobProgress(job_id, interval=0)
+    progress.advance()
+    expire(time.time() + 1)
+
+    with pytest.raises(app.JobNotRunningError):
+        progress.advance()
+    assert not progress.complete({'file_count': 1})
+    job = app.get_job(job_id)
+    assert job['state'] == app.JOB_FAILED
+    assert job['result'] is None
+
+def test_finished_jobs_are_pruned_with_their_batch_file(client, monkeypatch):
+    job_id = client.post('/jobs', json={'template': 'template.png', 'text_boxes': BOXES, 'csv_data': ROWS}).get_json()['id']
+    job = wait_for_job(client, job_id)
+    assert job['state'] == app.JOB_COMPLETE
+    path = os.path.join('static', 'downloads', job['result']['filename'])
+    failed = app.create_job('merge', {}, state=app.JOB_RUNNING)
+    app.JobProgress(failed).fail('boom')
+
+    expire()
+    assert os.path.exists(path)
+
+    monkeypatch.setitem(app.app.config, 'JOB_TTL', 60)
+    expire(time.time() + 61)
+    assert client.get(f'/jobs/{job_id}').status_code == 404
+    assert client.get(f'/jobs/{failed}').status_code == 404
+    assert not os.path.exists(path)
+
+def test_event_stream_keeps_queued_jobs_open():
+    job_id = app.create_job('merge', {})
+    events = app.iter_job_events(job_id, interval=0.01, wait=1, keepalive=0.05, stall=0.1)
+    messages = [next(events) for _ in range(4)]
+    assert messages[0].startswith('event: progress')
+    assert messages[1:] == [': keepalive\n\n'] * 3
+
+    app.claim_job(job_id)
+    messages = list(app.iter_job_events(job_id, interval=0.01, wait=1, stall=0.1))
+    assert [message.split('\n')[0] for message in messages] == ['event: progress', 'event: failed']
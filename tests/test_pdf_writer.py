@@ -0,0 +1,69 @@
+import io
+import re
+
+import pytest
+from PIL import Image
+
+import app
+
+def image_bytes(size, mode='RGB', fmt='JPEG'):
+    buf = io.BytesIO()
+    Image.new(mode, size, 'white' if mode == 'RGB' else 255).save(buf, format=fmt)
+    return buf.getvalue()
+
+# Pixel sizes of the pages written by write_pdf
+PAGE_SIZES = [(300, 150), (150, 300), (600, 600)]
+
+def write_pdf(dpi):
+    buf = io.BytesIO()
+    writer = app.PdfPageWriter(buf, dpi)
+    writer.add(0, image_bytes(PAGE_SIZES[0]))
+    writer.add(1, image_bytes(PAGE_SIZES[1], mode='L'))
+    writer.add(2, image_bytes(PAGE_SIZES[2]))
+    writer.close()
+    return buf.getvalue()
+
+def xref_offsets(pdf):
+    startxref = int(re.search(rb'startxref\n(\d+)\n%%EOF\n$', pdf).group(1))
+    assert pdf[startxref:].startswith(b'xref\n')
+    header, _, rest = pdf[startxref + len(b'xref\n'):].partition(b'\n')
+    first, count = map(int, header.split())
+    assert first == 0
+    entries = [rest[i * 20:(i + 1) * 20] for i in range(count)]
+    assert entries[0] == b'0000000000 65535 f \n'
+    return {obj_id: int(entry[:10]) for obj_id, entry in enumerate(entries) if obj_id}
+
+def test_xref_offsets_point_at_objects():
+    pdf = write_pdf(72)
+    offsets = xref_offsets(pdf)
+    # Three objects per page plus the page tree and catalog
+    assert sorted(offsets) == list(range(1, 2 + 3 * len(PAGE_SIZES) + 1))
+    for obj_id, offset in offsets.items():
+        assert pdf[offset:].startswith(f'{obj_id} 0 obj\n'.encode('ascii'))
+    assert re.search(rb'/Size (\d+)', pdf).group(1) == str(len(offsets) + 1).encode('ascii')
+
+def test_page_tree_counts_pages():
+    pdf = write_pdf(72)
+    pages = pdf[xref_offsets(pdf)[app.PdfPageWriter.PAGES_ID]:]
+    assert re.match(rb'2 0 obj\n<< /Type /Pages /Kids \[5 0 R 8 0 R 11 0 R\] /Count 3 >>', pages)
+
+@pytest.mark.parametrize('dpi', [72, 150, 300])
+def test_media_box_matches_dpi(dpi):
+    pdf = write_pdf(dpi)
+    boxes = re.findall(rb'/MediaBox \[0 0 ([\d.]+) ([\d.]+)\]', pdf)
+    assert len(boxes) == len(PAGE_SIZES)
+    for (width, height), (pixels_wide, pixels_high) in zip(boxes, PAGE_SIZES):
+        assert float(width) == pytest.approx(pixels_wide * 72 / dpi, abs=0.01)
+        assert float(height) == pytest.approx(pixels_high * 72 / dpi, abs=0.01)
+
+def test_grayscale_pages_use_device_gray():
+    pdf = write_pdf(72)
+    assert pdf.count(b'/ColorSpace /DeviceRGB') == 2
+    assert pdf.count(b'/ColorSpace /DeviceGray') == 1
+
+def test_rejects_non_jpeg_pages():
+    writer = app.PdfPageWriter(io.BytesIO(), 72)
+    with pytest.raises(ValueError):
+        writer.add(0, image_bytes((10, 10), fmt='PNG'))
+    with pytest.raises(ValueError):
+        writer.add(0, image_bytes((10, 10), mode='CMYK'))